@@ -1,3 +1,4 @@
+from bisect import bisect_left, bisect_right
 
 class CollectionSplitter(object):
 
@@ -7,7 +8,12 @@ class CollectionSplitter(object):
       return result_collection
 
 # Abstract class for post-processors that traverse segments, squashing curvature.
+#
+# Subclasses implement find_initial_segments(collection) to yield the
+# (way index, segment index, 'start' or 'end') of each point to squash around.
 class SquashCurvatureNearbyProcessorAbstract(object):
+    per_collection = True
+
     def __init__(self, distance=0):
         self.distance = distance
 
@@ -15,35 +21,16 @@ class SquashCurvatureNearbyProcessorAbstract(object):
         for collection in iterable:
             yield(self.process_collection(collection))
 
-    # Squash curvature values near an initial point out to our configured distance.
-    def squash_segment_curvature_nearby(self, collection, initial_way_index, initial_segment_index, initial_segment_end):
-        segments = CollectionSegmentTraverser(collection, initial_way_index, initial_segment_index)
-        # The initial matching segment will always have its curvature squashed.
-        initial_segment = segments.next()
-        self.squash_segment_curvature(initial_segment)
-
-        # Explore forward, squashing curvature until our distance has been exceeded.
-        if initial_segment_end == 'start':
-            d = initial_segment['length']
-        else:
-            d = 0
-        while d < self.distance and segments.has_next():
-            segment = segments.next()
+    def process_collection(self, collection):
+        index = CollectionSegmentIndex(collection)
+        for segment, count in index.count_segments_nearby(self.find_initial_segments(collection), self.distance):
             self.squash_segment_curvature(segment)
-            d = d + segment['length']
+        return collection
 
-        # Explore backward, squashing curvature until our distance has been exceeded.
-        segments.reset_postition()
-        segments.set_direction('backward')
-        segments.next() # We've already squashed the initial segment's curvature.
-        if initial_segment_end == 'end':
-            d = initial_segment['length']
-        else:
-            d = 0
-        while d < self.distance and segments.has_next():
-            segment = segments.next()
+    # Squash curvature values near an initial point out to our configured distance.
+    def squash_segment_curvature_nearby(self, collection, initial_way_index, initial_segment_index, initial_segment_end):
+        for segment in find_segments_nearby(collection, initial_way_index, initial_segment_index, initial_segment_end, self.distance):
             self.squash_segment_curvature(segment)
-            d = d + segment['length']
 
     # Squash the curvature values on a single segment.
     def squash_segment_curvature(self, segment):
@@ -53,7 +40,12 @@ class SquashCurvatureNearbyProcessorAbstract(object):
             segment['curvature_level'] = 0
 
 # Abstract class for post-processors that traverse segments, inflating curvature.
+#
+# Subclasses implement find_initial_segments(collection) to yield the
+# (way index, segment index, 'start' or 'end') of each point to inflate around.
 class InflateCurvatureNearbyProcessorAbstract(object):
+    per_collection = True
+
     def __init__(self, curvature=1, distance=0):
         self.curvature = curvature
         self.distance = distance
@@ -62,35 +54,18 @@ class InflateCurvatureNearbyProcessorAbstract(object):
         for collection in iterable:
             yield(self.process_collection(collection))
 
+    def process_collection(self, collection):
+        index = CollectionSegmentIndex(collection)
+        for segment, count in index.count_segments_nearby(self.find_initial_segments(collection), self.distance):
+            # Segments near several points are inflated for each of them.
+            for i in range(count):
+                self.inflate_segment_curvature(segment)
+        return collection
+
     # Inflate curvature values near an initial point out to our configured distance.
     def inflate_segment_curvature_nearby(self, collection, initial_way_index, initial_segment_index, initial_segment_end):
-        segments = CollectionSegmentTraverser(collection, initial_way_index, initial_segment_index)
-        # The initial matching segment will always have its curvature inflated.
-        initial_segment = segments.next()
-        self.inflate_segment_curvature(initial_segment)
-
-        # Explore forward, inflating curvature until our distance has been exceeded.
-        if initial_segment_end == 'start':
-            d = initial_segment['length']
-        else:
-            d = 0
-        while d < self.distance and segments.has_next():
-            segment = segments.next()
-            self.inflate_segment_curvature(segment)
-            d = d + segment['length']
-
-        # Explore backward, inflating curvature until our distance has been exceeded.
-        segments.reset_postition()
-        segments.set_direction('backward')
-        segments.next() # We've already inflated the initial segment's curvature.
-        if initial_segment_end == 'end':
-            d = initial_segment['length']
-        else:
-            d = 0
-        while d < self.distance and segments.has_next():
-            segment = segments.next()
+        for segment in find_segments_nearby(collection, initial_way_index, initial_segment_index, initial_segment_end, self.distance):
             self.inflate_segment_curvature(segment)
-            d = d + segment['length']
 
     # Inflate the curvature values on a single segment.
     def inflate_segment_curvature(self, segment):
@@ -101,6 +76,156 @@ class InflateCurvatureNearbyProcessorAbstract(object):
         if 'curvature_level' in segment.keys() and segment['curvature_level'] < 4:
             segment['curvature_level'] = segment['curvature_level'] + 1
 
+# Find the segments near an initial point in a collection, out to a distance.
+#
+# The initial point is the start or end of the initial segment. The initial
+# segment is always included, then segments are added forward and backward
+# until the distance has been exceeded.
+#
+# This walks the segments one at a time. When searching around many points
+# in the same collection, CollectionSegmentIndex.find_segments_nearby() finds
+# the same segments without walking them.
+def find_segments_nearby(collection, initial_way_index, initial_segment_index, initial_segment_end, distance):
+    nearby = []
+    segments = CollectionSegmentTraverser(collection, initial_way_index, initial_segment_index)
+    initial_segment = segments.next()
+    nearby.append(initial_segment)
+
+    # Explore forward until our distance has been exceeded.
+    if initial_segment_end == 'start':
+        d = initial_segment['length']
+    else:
+        d = 0
+    while d < distance and segments.has_next():
+        segment = segments.next()
+        nearby.append(segment)
+        d = d + segment['length']
+
+    # Explore backward until our distance has been exceeded.
+    segments.reset_postition()
+    segments.set_direction('backward')
+    segments.next() # We've already included the initial segment.
+    if initial_segment_end == 'end':
+        d = initial_segment['length']
+    else:
+        d = 0
+    while d < distance and segments.has_next():
+        segment = segments.next()
+        nearby.append(segment)
+        d = d + segment['length']
+    return nearby
+
+# An index of the segments of a collection by their distance along it, for
+# finding the segments near a point without walking through them.
+#
+# The segments of all ways are numbered in order and the distance along the
+# collection to the start of each is stored, so that the segments within a
+# distance of a point can be found with a binary search. As with
+# CollectionSegmentTraverser, a way without segments breaks the collection into
+# separate runs of segments which can't be traversed between.
+#
+# Note that since distances are summed along the whole collection rather than
+# outward from each point, a segment whose distance from the point is within
+# floating-point rounding of the search distance may be included or left out
+# differently than by find_segments_nearby().
+class CollectionSegmentIndex(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.segments = None
+
+    # Number the segments and sum their distances. This is only done once it
+    # is needed, as many collections won't have any points to search around.
+    def build(self):
+        self.segments = []
+        # The distance to the start of each segment, plus the total distance.
+        self.distances = [0]
+        # The position of the first segment of each way in our segments.
+        self.way_offsets = []
+        # The positions of the first and (after the) last segment of the run
+        # of segments each way is in.
+        self.run_starts = []
+        self.run_ends = []
+        run_start = 0
+        run_ways = 0
+        for way in self.collection['ways']:
+            self.way_offsets.append(len(self.segments))
+            if not way['segments']:
+                self.end_run(run_start, run_ways)
+                self.run_starts.append(len(self.segments))
+                self.run_ends.append(len(self.segments))
+                run_start = len(self.segments)
+                run_ways = 0
+                continue
+            for segment in way['segments']:
+                self.segments.append(segment)
+                self.distances.append(self.distances[-1] + segment['length'])
+            run_ways = run_ways + 1
+        self.end_run(run_start, run_ways)
+
+    def end_run(self, run_start, run_ways):
+        self.run_starts.extend([run_start] * run_ways)
+        self.run_ends.extend([len(self.segments)] * run_ways)
+
+    # Find the same segments as find_segments_nearby().
+    def find_segments_nearby(self, initial_way_index, initial_segment_index, initial_segment_end, distance):
+        start, k, end = self.find_range_nearby(initial_way_index, initial_segment_index, initial_segment_end, distance)
+        return [self.segments[k]] + self.segments[k + 1:end] + self.segments[start:k][::-1]
+
+    # Return a list of (segment, count) for the segments near any of a list of
+    # (way index, segment index, 'start' or 'end') initial points, where count
+    # is the number of the points the segment is near.
+    def count_segments_nearby(self, initial_segments, distance):
+        counts = None
+        for way_index, segment_index, segment_end in initial_segments:
+            if counts is None:
+                if self.segments is None:
+                    self.build()
+                # The changes in the count at the start and end of each range.
+                counts = [0] * (len(self.segments) + 1)
+            start, k, end = self.find_range_nearby(way_index, segment_index, segment_end, distance)
+            counts[start] += 1
+            counts[end] -= 1
+        if counts is None:
+            return []
+        result = []
+        count = 0
+        for i, segment in enumerate(self.segments):
+            count = count + counts[i]
+            if count:
+                result.append((segment, count))
+        return result
+
+    # Find the range of the segments near an initial point.
+    #
+    # Returns a tuple of the position of the first segment, the initial
+    # segment, and after the last segment in our segments.
+    def find_range_nearby(self, initial_way_index, initial_segment_index, initial_segment_end, distance):
+        if self.segments is None:
+            self.build()
+        # Raise an IndexError for segments that don't exist.
+        initial_segment = self.collection['ways'][initial_way_index]['segments'][initial_segment_index]
+        if initial_segment_index < 0:
+            raise IndexError('segment index out of range')
+        k = self.way_offsets[initial_way_index] + initial_segment_index
+
+        # Forward, segments are included while the distance from the initial
+        # point to their start is less than our distance.
+        if initial_segment_end == 'start':
+            d = initial_segment['length']
+        else:
+            d = 0
+        end = bisect_left(self.distances, self.distances[k + 1] + (distance - d), k + 1, self.run_ends[initial_way_index])
+
+        # Backward, segments are included while the distance from the initial
+        # point to their end is less than our distance.
+        if initial_segment_end == 'end':
+            d = initial_segment['length']
+        else:
+            d = 0
+        start = bisect_right(self.distances, self.distances[k] - (distance - d), self.run_starts[initial_way_index] + 1, k + 1) - 1
+        return (start, k, end)
+
 # Utility class for traversing through adjoining segments in a collection.
 class CollectionSegmentTraverser(object):
 
@@ -1,10 +1,19 @@
+import os
 import sys
 import math
 import resource
 from copy import copy
+from array import array
 import time
+import multiprocessing
+import pickle
+import hashlib
+import shutil
+import tempfile
+import zlib
 import osmium
-from osmium._osmium import InvalidLocationError
+from curvature.collection_tools import CollectionSplitter
+from curvature.match import compile_match
 
 # simple class that handles the parsed OSM data.
 class WayCollector(osmium.SimpleHandler):
@@ -17,6 +26,45 @@ class WayCollector(osmium.SimpleHandler):
     num_nodes = 0
     verbose = False
     roads = []
+    jobs = 1
+    # The type of index used to store node locations. 'auto' will choose a
+    # sparse or dense index based on the size of the input file. The file-backed
+    # types store their index in node_index_file, which will be reused by later
+    # runs on the same input file.
+    node_index = 'auto'
+    node_index_file = None
+    # If true, make a first pass over the ways so that only tagged nodes that
+    # are referenced by our ways are kept.
+    referenced_nodes_only = False
+    referenced_node_tracker = None
+    # If not empty, only keep tagged nodes that have one of these tag keys.
+    node_tags = []
+    # Match expressions for ways to filter out of the output.
+    filter_out_matches = []
+    filtered_way_ids = set()
+    # If true, collections are sent to the callback (and released) as soon as
+    # they are complete rather than after all routes have been joined. Ways
+    # without a route are sent as they are read, so this requires input files
+    # that are sorted with nodes before ways, as OSM files normally are.
+    emit_incrementally = False
+    callback = None
+    # Above this many nodes a dense index (8 bytes for every node id in use in
+    # OSM, ~12 billion) becomes smaller than a sparse one (16 bytes per node).
+    dense_index_min_nodes = 6000000000
+    # If set, the approximate number of bytes that the ways held in our routes
+    # and unjoined collections may use. When this is exceeded they are spilled
+    # to files in spill_dir (or the system's temporary directory). Routes are
+    # written to partitions based on their name/ref, each of which is later
+    # loaded and joined on its own. A partition that has grown larger than
+    # max_memory is split again before it is loaded. Each route is joined
+    # whole, so a single route larger than max_memory is still loaded at once.
+    max_memory = None
+    spill_dir = None
+    spill_partitions = 64
+    spill_path = None
+    held_size = 0
+    # The estimated size of the ways spilled to each partition.
+    partition_sizes = {}
 
     def __init__(self):
         osmium.SimpleHandler.__init__(self)
@@ -32,6 +80,10 @@ class WayCollector(osmium.SimpleHandler):
         self.coords = {}
         self.routes = {}
         self.tagged_nodes = {}
+        self.filtered_way_ids = set()
+        self.callback = callback
+        self.held_size = 0
+        self.partition_sizes = {}
         num_coords = 0
         num_ways = 0
         num_nodes = 0
@@ -39,11 +91,31 @@ class WayCollector(osmium.SimpleHandler):
         self.log("Loading {}".format(filename))
         self.log("Loading ways and nodes, each '-' is 100 ways, each '.' is 100 nodes, each row is 10,000 ways or nodes")
 
-        self.apply_file(filename, locations=True, idx='sparse_mem_array')
+        self.load_file(filename)
 
         self.log("\nWays and nodes loaded matched in {}".format(filename))
 
+        if self.spill_path is not None:
+            self.log("Streaming collections as spilled routes are joined")
+            self.spill_routes()
+            self.join_spilled_routes(callback)
+            del self.tagged_nodes
+            self.filtered_way_ids = set()
+            self.callback = None
+            self.log('\nStreaming completed in {time:.1f}'.format(time=(time.time() - start_time)))
+            return
+
+        if self.emit_incrementally:
+            self.log("Streaming collections as routes are joined")
+            self.join_ways(callback)
+            del self.tagged_nodes
+            self.filtered_way_ids = set()
+            self.callback = None
+            self.log('\nStreaming completed in {time:.1f}'.format(time=(time.time() - start_time)))
+            return
+
         self.join_ways()
+        self.remove_filtered_ways()
         self.attach_tagged_nodes_to_ways()
 
         # Send our collected data to our callback function.
@@ -62,10 +134,129 @@ class WayCollector(osmium.SimpleHandler):
                 if not (i % collections_marker):
                     sys.stderr.write('.')
                     sys.stderr.flush()
-            callback(collection)
+            callback(self.export_collection(collection))
         self.log('\nStreaming completed in {time:.1f}'.format(time=(time.time() - start_time)))
 
+    # Read the nodes and ways in a file, storing node locations so that they
+    # are available to our way handler.
+    def load_file(self, filename):
+        index_type = self.choose_node_index(filename)
+        reuse_index = False
+        if index_type.endswith('_file_array'):
+            if not self.node_index_file:
+                raise ValueError('A node index file is required for the {} node index.'.format(index_type))
+            source = self.get_node_index_source(filename, index_type)
+            reuse_index = self.node_index_matches_source(source)
+            if not reuse_index:
+                # Start with a clean index file so that no stale locations remain.
+                for path in (self.node_index_file, self.node_index_file + '.source'):
+                    if os.path.exists(path):
+                        os.remove(path)
+            location_index = osmium.index.create_map('{},{}'.format(index_type, self.node_index_file))
+        else:
+            location_index = osmium.index.create_map(index_type)
+        location_handler = osmium.NodeLocationsForWays(location_index)
+        location_handler.ignore_errors()
+
+        if self.referenced_nodes_only:
+            self.track_referenced_nodes(filename)
+
+        if reuse_index:
+            self.log("Reusing {} node index {}".format(index_type, self.node_index_file))
+            # The locations are already indexed, so nodes only need to go to our
+            # own node handler, not the location handler.
+            handlers = [*self.get_node_filters(), NodeHandler(self), osmium.filter.EntityFilter(osmium.osm.WAY), location_handler, *self.get_way_filters(), self]
+        else:
+            self.log("Using {} node index".format(index_type))
+            # All node locations must be indexed before filtering.
+            handlers = [location_handler, *self.get_node_filters(), *self.get_way_filters(), self]
+
+        with osmium.io.Reader(filename, osmium.osm.NODE | osmium.osm.WAY) as reader:
+            osmium.apply(reader, *handlers)
+
+        # Record the input that the index was built from so that it can be reused.
+        # The index is released first so that it has been written out to its file.
+        del handlers, location_handler, location_index
+        self.referenced_node_tracker = None
+        if index_type.endswith('_file_array') and not reuse_index:
+            with open(self.node_index_file + '.source', 'w') as f:
+                f.write(source)
+
+    # Make a first pass over the ways in a file to find the nodes that they
+    # reference so that other tagged nodes can be skipped.
+    def track_referenced_nodes(self, filename):
+        start_time = time.time()
+        self.log("Finding nodes referenced by ways in {}".format(filename))
+        self.referenced_node_tracker = osmium.IdTracker()
+        with osmium.io.Reader(filename, osmium.osm.WAY) as reader:
+            osmium.apply(reader, *self.get_way_filters(), NodeReferenceTracker(self.referenced_node_tracker))
+        self.log("Referenced nodes found in {time:.1f} seconds".format(time=(time.time() - start_time)))
+
+    # Filters applied by osmium so that only tagged nodes (that we are
+    # interested in) reach our node handler.
+    def get_node_filters(self):
+        filters = [osmium.filter.EmptyTagFilter().enable_for(osmium.osm.NODE)]
+        if self.node_tags:
+            filters.append(osmium.filter.KeyFilter(*self.node_tags).enable_for(osmium.osm.NODE))
+        if self.referenced_node_tracker is not None:
+            filters.append(self.referenced_node_tracker.id_filter().enable_for(osmium.osm.NODE))
+        return filters
+
+    # Filters applied by osmium so that only highway ways (of the types we are
+    # interested in) reach our way handler.
+    def get_way_filters(self):
+        filters = [osmium.filter.KeyFilter('highway').enable_for(osmium.osm.WAY)]
+        if self.roads:
+            filters.append(osmium.filter.TagFilter(*[('highway', road) for road in self.roads]).enable_for(osmium.osm.WAY))
+        return filters
+
+    # Choose a node location index type for a file.
+    def choose_node_index(self, filename):
+        if self.node_index != 'auto':
+            return self.node_index
+
+        # Files covering the whole world (e.g. the planet file) will have nodes
+        # for most ids, so will use less space with a dense index. Otherwise,
+        # estimate the number of nodes from the file size.
+        with osmium.io.Reader(filename, osmium.osm.NOTHING) as reader:
+            box = reader.header().box()
+        if box.valid() and box.top_right.lon - box.bottom_left.lon >= 359 and box.top_right.lat - box.bottom_left.lat >= 179:
+            dense = True
+        else:
+            dense = self.estimate_num_nodes(filename) >= self.dense_index_min_nodes
+
+        if dense and self.node_index_file:
+            return 'dense_file_array'
+        elif dense:
+            return 'dense_mmap_array'
+        elif self.node_index_file:
+            return 'sparse_file_array'
+        else:
+            return 'sparse_mem_array'
+
+    # Roughly estimate the number of nodes in a file from its size.
+    def estimate_num_nodes(self, filename):
+        # Nodes make up most of an OSM file, taking roughly 8 bytes each in
+        # PBF files and roughly 100 bytes each in XML files.
+        if filename.endswith('.pbf'):
+            return os.path.getsize(filename) / 8
+        else:
+            return os.path.getsize(filename) / 100
+
+    # Describe the input file that a file-backed node index is built from.
+    def get_node_index_source(self, filename, index_type):
+        stat = os.stat(filename)
+        return '{}\n{}\n{}\n{}\n'.format(index_type, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+    # Answer true if an existing node index file was built from the source given.
+    def node_index_matches_source(self, source):
+        if not os.path.exists(self.node_index_file) or not os.path.exists(self.node_index_file + '.source'):
+            return False
+        with open(self.node_index_file + '.source') as f:
+            return f.read() == source
+
     # Save tagged nodes save the full details for later adding to ways.
+    # Untagged nodes are normally filtered out before reaching this handler.
     def node(self, node):
         if node.tags:
             new_node = {
@@ -94,15 +285,28 @@ class WayCollector(osmium.SimpleHandler):
                 self.log('\nSkipping single-point way: id: {}, tags: {}, nodes: {}\n'.format(way.id, way.tags, way.nodes))
                 return
 
-            new_way = {'id': way.id, 'tags': {}, 'refs': [], 'coords': [], 'nodes': {}}
+            # Refs and coordinates are held in packed arrays while collecting
+            # and are converted to lists when the collections are sent along.
+            # See pack_location() for the coordinate format.
+            new_way = {'id': way.id, 'tags': {}, 'refs': array('q'), 'coords': array('q'), 'nodes': {}}
             for tag in way.tags:
                 new_way['tags'][tag.k] = tag.v
             for node in way.nodes:
-                try:
+                location = node.location
+                if location.valid():
                     new_way['refs'].append(node.ref)
-                    new_way['coords'].append((node.lat, node.lon))
-                except InvalidLocationError as e:
-                    self.log('\nSkipping node: {} (x={}, y={}) because of error: {}\n'.format(node.ref, node.x, node.y, e))
+                    new_way['coords'].append(pack_location(location.y, location.x))
+                else:
+                    self.log('\nSkipping node: {} (x={}, y={}) because of an invalid location\n'.format(node.ref, node.x, node.y))
+
+            # Ways that match our filters won't be output. They still need to be
+            # joined into their routes though, so that the remaining ways are
+            # joined and split exactly as they would be if the filtered ways
+            # were removed later by the filter_out_ways post-processor. Their
+            # coordinates aren't needed for this, so drop them now.
+            if self.filter_out_matches and self.way_is_filtered_out(new_way):
+                self.filtered_way_ids.add(new_way['id'])
+                new_way['coords'] = array('q')
 
             # Add our ways to a route collection if we can match them either
             # by route-number or alternatively, by name. These route-collections
@@ -113,52 +317,32 @@ class WayCollector(osmium.SimpleHandler):
             if 'ref' in new_way['tags']:
                 routes = new_way['tags']['ref'].split(';')
                 for route in routes:
-                    if route not in self.routes:
-                        self.routes[route] = {  'join_type': 'ref',
-                                                'join_data': route,
-                                                'ways': []}
-                    self.routes[route]['ways'].append(new_way)
+                    self.add_way_to_route('ref', route, new_way)
             elif 'official_ref' in new_way['tags']:
                 routes = new_way['tags']['official_ref'].split(';')
                 for route in routes:
-                    if route not in self.routes:
-                        self.routes[route] = {  'join_type': 'ref',
-                                                'join_data': route,
-                                                'ways': []}
-                    self.routes[route]['ways'].append(new_way)
+                    self.add_way_to_route('ref', route, new_way)
             elif 'admin_ref' in new_way['tags']:
                 routes = new_way['tags']['admin_ref'].split(';')
                 for route in routes:
-                    if route not in self.routes:
-                        self.routes[route] = {  'join_type': 'ref',
-                                                'join_data': route,
-                                                'ways': []}
-                    self.routes[route]['ways'].append(new_way)
+                    self.add_way_to_route('ref', route, new_way)
             elif 'highway_ref' in new_way['tags']:
                 routes = new_way['tags']['highway_ref'].split(';')
                 for route in routes:
-                    if route not in self.routes:
-                        self.routes[route] = {  'join_type': 'ref',
-                                                'join_data': route,
-                                                'ways': []}
-                    self.routes[route]['ways'].append(new_way)
+                    self.add_way_to_route('ref', route, new_way)
             elif 'highway_authority_ref' in new_way['tags']:
                 routes = new_way['tags']['highway_authority_ref'].split(';')
                 for route in routes:
-                    if route not in self.routes:
-                        self.routes[route] = {  'join_type': 'ref',
-                                                'join_data': route,
-                                                'ways': []}
-                    self.routes[route]['ways'].append(new_way)
+                    self.add_way_to_route('ref', route, new_way)
             else:
                 if 'name' in new_way['tags'] and new_way['tags']['name'] != '':
-                    if new_way['tags']['name'] not in self.routes:
-                        self.routes[new_way['tags']['name']] = {   'join_type': 'name',
-                                                        'join_data': new_way['tags']['name'],
-                                                        'ways': []}
-                    self.routes[new_way['tags']['name']]['ways'].append(new_way)
-                else:
-                    self.collections.append({'join_type': 'none', 'ways': [new_way]})
+                    self.add_way_to_route('name', new_way['tags']['name'], new_way)
+                elif new_way['id'] not in self.filtered_way_ids:
+                    if self.emit_incrementally:
+                        self.emit_collections([{'join_type': 'none', 'ways': [new_way]}], self.callback)
+                    else:
+                        self.collections.append({'join_type': 'none', 'ways': [new_way]})
+                        self.add_to_held_size(new_way)
 
             # status output
             if self.verbose:
@@ -171,6 +355,204 @@ class WayCollector(osmium.SimpleHandler):
                         sys.stderr.write('\n')
                     sys.stderr.flush()
 
+    # Add a way to the route with the given name/ref, spilling our routes to
+    # disk if they have grown past our memory limit.
+    def add_way_to_route(self, join_type, route, way):
+        if route not in self.routes:
+            self.routes[route] = {  'join_type': join_type,
+                                    'join_data': route,
+                                    'ways': []}
+        self.routes[route]['ways'].append(way)
+        self.add_to_held_size(way)
+
+    # Count a way against our memory limit, spilling our routes and
+    # collections to disk if they have grown past it.
+    def add_to_held_size(self, way):
+        if self.max_memory is not None:
+            self.held_size += self.estimate_way_size(way)
+            if self.held_size > self.max_memory:
+                self.spill_routes()
+
+    # A rough estimate of the memory used by one of our ways.
+    def estimate_way_size(self, way):
+        size = 600 + len(way['refs']) * 16
+        for key, value in way['tags'].items():
+            size += 150 + len(key) + len(value)
+        return size
+
+    # Append the ways of our routes to our partition files and our unjoined
+    # collections to their own file and release them.
+    def spill_routes(self):
+        if self.spill_path is None:
+            self.spill_path = tempfile.mkdtemp(prefix='curvature-routes-', dir=self.spill_dir)
+            self.log("\nSpilling routes to {}".format(self.spill_path))
+        partitions = {}
+        for route, route_data in self.routes.items():
+            partition = zlib.crc32(route.encode('utf-8')) % self.spill_partitions
+            partitions.setdefault(partition, []).append((route, route_data))
+        for partition, partition_routes in partitions.items():
+            with open(self.get_spill_file(partition), 'ab') as spill_file:
+                for route, route_data in partition_routes:
+                    pickle.dump((route, route_data), spill_file, pickle.HIGHEST_PROTOCOL)
+                    self.partition_sizes[partition] = self.partition_sizes.get(partition, 0) + self.estimate_route_size(route_data)
+        if self.collections:
+            with open(os.path.join(self.spill_path, 'collections'), 'ab') as spill_file:
+                for collection in self.collections:
+                    pickle.dump(collection, spill_file, pickle.HIGHEST_PROTOCOL)
+        self.routes = {}
+        self.collections = []
+        self.held_size = 0
+
+    def estimate_route_size(self, route_data):
+        return sum(self.estimate_way_size(way) for way in route_data['ways'])
+
+    def get_spill_file(self, partition):
+        return os.path.join(self.spill_path, 'partition-{}'.format(partition))
+
+    # Read the records pickled to a spill file in order.
+    def read_spill_file(self, path):
+        with open(path, 'rb') as spill_file:
+            while True:
+                try:
+                    yield(pickle.load(spill_file))
+                except EOFError:
+                    break
+
+    # Load each of our partition files in turn and join and send along its
+    # routes before moving on to the next.
+    #
+    # Within a partition routes are joined in the order they were first seen,
+    # but collections are not output in the same overall order as when joining
+    # in memory.
+    def join_spilled_routes(self, callback):
+        try:
+            # Our unjoined collections are sent along first, as they are when
+            # joining in memory.
+            path = os.path.join(self.spill_path, 'collections')
+            if os.path.exists(path):
+                for collection in self.read_spill_file(path):
+                    self.emit_collections([collection], callback)
+                os.remove(path)
+
+            for partition in sorted(self.partition_sizes.keys()):
+                self.join_spill_file(self.get_spill_file(partition), self.partition_sizes[partition], callback)
+        finally:
+            shutil.rmtree(self.spill_path, ignore_errors=True)
+            self.spill_path = None
+            self.partition_sizes = {}
+            self.routes = {}
+
+    # Load and join the routes in a partition file. If the partition is larger
+    # than max_memory its routes are first split across several smaller files
+    # which are joined in turn. Route names are hashed with a different key at
+    # each depth, as CRCs of names of the same length that collide once always
+    # will. Files holding only a single route can't be split any further and
+    # are loaded whole.
+    def join_spill_file(self, path, size, callback, depth=0):
+        if size > self.max_memory:
+            num_partitions = max(2, min(self.spill_partitions, size // self.max_memory + 1))
+            sizes = {}
+            route_names = {}
+            files = {}
+            try:
+                for route, route_data in self.read_spill_file(path):
+                    digest = hashlib.blake2b(route.encode('utf-8'), digest_size=8, key=str(depth).encode('utf-8')).digest()
+                    partition = int.from_bytes(digest, 'little') % num_partitions
+                    if partition not in files:
+                        files[partition] = open('{}-{}'.format(path, partition), 'wb')
+                    pickle.dump((route, route_data), files[partition], pickle.HIGHEST_PROTOCOL)
+                    sizes[partition] = sizes.get(partition, 0) + self.estimate_route_size(route_data)
+                    route_names.setdefault(partition, set()).add(route)
+            finally:
+                for file in files.values():
+                    file.close()
+            os.remove(path)
+            for partition in sorted(sizes.keys()):
+                partition_path = '{}-{}'.format(path, partition)
+                if len(route_names[partition]) > 1:
+                    self.join_spill_file(partition_path, sizes[partition], callback, depth + 1)
+                else:
+                    self.join_spill_partition(partition_path, callback)
+            return
+        self.join_spill_partition(path, callback)
+
+    def join_spill_partition(self, path, callback):
+        self.routes = {}
+        for route, route_data in self.read_spill_file(path):
+            # Later parts of a route continue the ways of the first.
+            if route in self.routes:
+                self.routes[route]['ways'].extend(route_data['ways'])
+            else:
+                self.routes[route] = route_data
+        os.remove(path)
+        self.join_ways(callback)
+
+    # Add a match expression for ways to filter out of the output.
+    # Example: 'And(TagEquals("highway", "service"), TagEquals("access", "private"))'
+    def add_way_filter(self, match_expression):
+        match = compile_match(match_expression)
+        self.filter_out_matches = self.filter_out_matches + [match]
+
+    def way_is_filtered_out(self, way):
+        for match in self.filter_out_matches:
+            if match.match_way(way):
+                return True
+        return False
+
+    # Remove the filtered ways from our joined collections.
+    def remove_filtered_ways(self):
+        if not self.filtered_way_ids:
+            return
+        self.collections = self.split_filtered_ways(self.collections)
+        self.filtered_way_ids = set()
+
+    # Remove the filtered ways from a list of collections, splitting the
+    # collections where ways are removed in the same way as the
+    # filter_out_ways post-processor.
+    def split_filtered_ways(self, collections):
+        if not self.filtered_way_ids:
+            return collections
+        splitter = CollectionSplitter()
+        result_collections = []
+        for collection in collections:
+            result_collection = splitter.create_result_collection(collection)
+            for way in collection['ways']:
+                if way['id'] in self.filtered_way_ids:
+                    if result_collection['ways']:
+                        result_collections.append(result_collection)
+                        result_collection = splitter.create_result_collection(collection)
+                else:
+                    result_collection['ways'].append(way)
+            if result_collection['ways']:
+                result_collections.append(result_collection)
+        return result_collections
+
+    # Finish collections and send them to a callback.
+    def emit_collections(self, collections, callback):
+        for collection in self.split_filtered_ways(collections):
+            self.attach_tagged_nodes_to_collection(collection)
+            callback(self.export_collection(collection))
+
+    # Convert a collection from our packed storage to the lists and tuples of
+    # our output format.
+    def export_collection(self, collection):
+        result_collection = dict((key, value) for key, value in collection.items() if key != 'ways')
+        result_collection['ways'] = [self.export_way(way) for way in collection['ways']]
+        return result_collection
+
+    def export_way(self, way):
+        result_way = dict(way)
+        result_way['refs'] = list(way['refs'])
+        result_way['coords'] = []
+        for ref, packed in zip(way['refs'], way['coords']):
+            lat, lon = unpack_location(packed)
+            # Add the ref of tagged nodes to the coords tuple to associate it.
+            if ref in way['nodes']:
+                result_way['coords'].append((lat, lon, ref))
+            else:
+                result_way['coords'].append((lat, lon))
+        return result_way
+
     def way_sort_key(self, way):
         # To encourage joining that continues along the length of route rather
         # than doubling back on roundabouts, ramps, islands, and other split-route
@@ -231,7 +613,10 @@ class WayCollector(osmium.SimpleHandler):
         return key
 
     # Join numbered/named routes end-to-end and add them to the way list.
-    def join_ways(self):
+    # If a callback is given, the collections of each route are instead
+    # finished and sent to it as soon as the route is joined, and the route
+    # is released.
+    def join_ways(self, callback=None):
         # status output
         start_time = time.time()
         i = 0
@@ -242,99 +627,179 @@ class WayCollector(osmium.SimpleHandler):
             marker = round(total/100)
         self.log("{} routes will be joined, each '.' is 1% complete".format(total))
 
-        for route, route_data in self.routes.items():
-            # Sort ways so that joining always happens in the same order
-            # even if the parser returns them in a different order.
-            # ways = sorted(route_data['ways'], key=lambda way: way['id'])
-            ways = sorted(route_data['ways'], key=lambda way: self.way_sort_key(way))
-
-            # status output
-            if self.verbose:
-                i = i + 1
-                if not (i % marker):
-                    sys.stderr.write('.')
-                    sys.stderr.flush()
-
-            while len(ways) > 0:
-                collection = {  'join_type': route_data['join_type'],
-                                'join_data': route_data['join_data'],
-                                'ways': [ways.pop(0)] }
-                # A list of all refs added to a collection. Checking this list will
-                # prevent creating non-linar forking structures.
-                collection_refs = [collection['ways'][0]['refs']]
-                # Loop through all our ways at least as many times as we have ways
-                # to be able to catch any that join onto the end after others have
-                # been joined on.
-                j = 0
-                max_loop = len(ways)
-                # Start our first iteration with the "collection_modified" flag set to True.
-                # After this first loop, if no ways get added to the base_way,
-                # there is no reason to keep looping until max_loop
-                collection_modified = True
-                while collection_modified and j < max_loop:
-                    j = j + 1
-                    # Set our modification flag to False so we can detect changes
-                    # to the base_way.
-                    collection_modified = False
-                    unused_ways = []
-                    # try to join to the begining or end
-                    while len(ways) > 0:
-                        way = ways.pop(0)
-                        modified_this_pass = False
-                        # join to the end of the base in order
-                        if collection['ways'][-1]['refs'][-1] == way['refs'][0] and way['refs'][-1] not in collection_refs:
-                            collection_modified = True
-                            modified_this_pass = True
-                            collection['ways'].append(way)
-                            collection_refs = collection_refs + way['refs']
-                        # join to the end of the base in reverse order
-                        elif collection['ways'][-1]['refs'][-1] == way['refs'][-1] and way['refs'][0] not in collection_refs:
-                            # Make a copy of the way before modifying it as it may be
-                            # a member of other routes that will be joined in a different sequence.
-                            way_copy = copy(way)
-                            way_copy['refs'] = list(reversed(way_copy['refs']))
-                            way_copy['coords'] = list(reversed(way_copy['coords']))
-                            collection_modified = True
-                            modified_this_pass = True
-                            collection['ways'].append(way_copy)
-                            collection_refs = collection_refs + way_copy['refs']
-
-                        # join to the beginning of the base in order
-                        elif collection['ways'][0]['refs'][0] == way['refs'][-1] and way['refs'][0] not in collection_refs:
-                            collection_modified = True
-                            modified_this_pass = True
-                            collection['ways'].insert(0, way)
-                            collection_refs =  way['refs'] + collection_refs
-
-                        # join to the beginning of the base in reverse order
-                        elif collection['ways'][0]['refs'][0] == way['refs'][0] and way['refs'][-1] not in collection_refs:
-                            # Make a copy of the way before modifying it as it may be
-                            # a member of other routes that will be joined in a different sequence.
-                            way_copy = copy(way)
-                            collection_modified = True
-                            modified_this_pass = True
-                            way_copy['refs'] = list(reversed(way_copy['refs']))
-                            way_copy['coords'] = list(reversed(way_copy['coords']))
-                            collection['ways'].insert(0, way_copy)
-                            collection_refs = way_copy['refs'] + collection_refs
-                        else:
-                            unused_ways.append(way)
-                        # If we've modified our collection with a new end-way, start looping
-                        # again from our sorted list so that we join in the correct order.
-                        if modified_this_pass:
-                            ways = unused_ways + ways
-                            unused_ways = []
-
-                    # Continue on joining the rest of the ways in this route.
-                    ways = unused_ways
-                # After we've either added all of the ways or looped the max_loop times,
-                # add this collection to our collections list and return to the start
-                # of our `while len(ways) > 0:` loop. The next remaining way in the
-                # ways list will become the basis for a new collection that may get
-                # some more of the remaining ways joined to it.
-                self.collections.append(collection)
+        routes = list(self.routes.values())
+        if callback is not None:
+            # Our list will hold the only references to the routes so that each
+            # can be released once its collections have been sent along.
+            self.routes = {}
+        # Routes never share collections, so they can be planned in separate
+        # processes. Workers are forked so that they share our routes rather
+        # than having them serialized and only send back the (small) join plan
+        # for each route. Plans are returned in the order of our routes so that
+        # the output is the same as when joining in a single process.
+        global forked_collector, forked_routes
+        if self.jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            forked_collector = self
+            forked_routes = routes
+            pool = multiprocessing.get_context('fork').Pool(self.jobs)
+            chunksize = max(1, min(100, total // (self.jobs * 4)))
+            plans = pool.imap(plan_route_joins_in_worker, range(total), chunksize)
+        else:
+            pool = None
+            plans = map(lambda route_data: self.plan_route_joins(route_data['ways']), routes)
+
+        try:
+            for j, route_plan in enumerate(plans):
+                # status output
+                if self.verbose:
+                    i = i + 1
+                    if not (i % marker):
+                        sys.stderr.write('.')
+                        sys.stderr.flush()
+
+                collections = self.assemble_route_collections(routes[j], route_plan)
+                if callback is None:
+                    self.collections.extend(collections)
+                else:
+                    routes[j] = None
+                    self.emit_collections(collections, callback)
+
+            if pool is not None:
+                pool.close()
+        finally:
+            # Don't leave workers running or hold on to our routes if
+            # assembling or sending along the collections failed.
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+                forked_collector = None
+                forked_routes = None
         self.log('\nJoining completed in {time:.1f} seconds'.format(time=(time.time() - start_time)))
 
+    # Join the ways of a single route end-to-end and return the resulting collections.
+    def join_route(self, route_data):
+        return self.assemble_route_collections(route_data, self.plan_route_joins(route_data['ways']))
+
+    # Build the collections for a route from the plan returned by plan_route_joins().
+    def assemble_route_collections(self, route_data, route_plan):
+        collections = []
+        for collection_plan in route_plan:
+            collection = {  'join_type': route_data['join_type'],
+                            'join_data': route_data['join_data'],
+                            'ways': [] }
+            for i, reverse in collection_plan:
+                if reverse:
+                    collection['ways'].append(self.reversed_way(route_data['ways'][i]))
+                else:
+                    collection['ways'].append(route_data['ways'][i])
+            collections.append(collection)
+        return collections
+
+    # Plan how the ways of a single route will be joined end-to-end.
+    #
+    # Returns a list of collections, each of which is a list of
+    # (way index, reversed) tuples referencing the route's ways.
+    #
+    # The first unused way (in sort order) becomes the base of a new collection.
+    # We then repeatedly join on the first unused way (in sort order) that can be
+    # attached to either end of the collection until no more ways can be joined,
+    # at which point the next unused way becomes the base of another collection.
+    #
+    # Rather than re-scanning every unused way after each join, the unused ways
+    # are indexed by their first and last refs so that only the handful of ways
+    # that touch the ends of the collection need to be checked.
+    def plan_route_joins(self, route_ways):
+        # Sort ways so that joining always happens in the same order
+        # even if the parser returns them in a different order.
+        order = sorted(range(len(route_ways)), key=lambda i: self.way_sort_key(route_ways[i]))
+        ways = [route_ways[i] for i in order]
+
+        # Index the positions of the ways in our sorted list by their end-refs.
+        first_ref_index = {}
+        last_ref_index = {}
+        for i, way in enumerate(ways):
+            first_ref_index.setdefault(way['refs'][0], []).append(i)
+            last_ref_index.setdefault(way['refs'][-1], []).append(i)
+        used = [False] * len(ways)
+
+        route_plan = []
+        base_index = 0
+        while base_index < len(ways):
+            base_way = ways[base_index]
+            self.mark_way_used(ways, base_index, used, first_ref_index, last_ref_index)
+            # Ways prepended to the collection are accumulated in reverse order.
+            head = []
+            tail = []
+            start_ref = base_way['refs'][0]
+            end_ref = base_way['refs'][-1]
+            # A set of all refs added to a collection. Checking this set will
+            # prevent creating non-linar forking structures.
+            # Note that the refs of the base way are not included. This matches
+            # the long-standing behavior of the joiner and keeps output stable.
+            collection_refs = set()
+
+            while True:
+                candidates = set()
+                for ref in (start_ref, end_ref):
+                    candidates.update(first_ref_index.get(ref, ()))
+                    candidates.update(last_ref_index.get(ref, ()))
+                joined = False
+                for i in sorted(candidates):
+                    way = ways[i]
+                    first_ref = way['refs'][0]
+                    last_ref = way['refs'][-1]
+                    # join to the end of the base in order
+                    if end_ref == first_ref and last_ref not in collection_refs:
+                        tail.append((order[i], False))
+                        end_ref = last_ref
+                    # join to the end of the base in reverse order
+                    elif end_ref == last_ref and first_ref not in collection_refs:
+                        tail.append((order[i], True))
+                        end_ref = first_ref
+                    # join to the beginning of the base in order
+                    elif start_ref == last_ref and first_ref not in collection_refs:
+                        head.append((order[i], False))
+                        start_ref = first_ref
+                    # join to the beginning of the base in reverse order
+                    elif start_ref == first_ref and last_ref not in collection_refs:
+                        head.append((order[i], True))
+                        start_ref = last_ref
+                    else:
+                        continue
+                    collection_refs.update(way['refs'])
+                    self.mark_way_used(ways, i, used, first_ref_index, last_ref_index)
+                    joined = True
+                    # Start looking again from the beginning of our sorted list
+                    # so that we join in the correct order.
+                    break
+                if not joined:
+                    break
+
+            head.reverse()
+            route_plan.append(head + [(order[base_index], False)] + tail)
+
+            # The next remaining way in sort order will become the basis for
+            # a new collection that may get some more of the remaining ways
+            # joined to it.
+            while base_index < len(ways) and used[base_index]:
+                base_index = base_index + 1
+        return route_plan
+
+    # Flag a way as used and remove it from the end-ref indexes.
+    def mark_way_used(self, ways, i, used, first_ref_index, last_ref_index):
+        used[i] = True
+        first_ref_index[ways[i]['refs'][0]].remove(i)
+        last_ref_index[ways[i]['refs'][-1]].remove(i)
+
+    # Make a reversed copy of a way.
+    def reversed_way(self, way):
+        # Make a copy of the way before modifying it as it may be
+        # a member of other routes that will be joined in a different sequence.
+        way_copy = copy(way)
+        way_copy['refs'] = way_copy['refs'][::-1]
+        way_copy['coords'] = way_copy['coords'][::-1]
+        return way_copy
+
     # Attach tagged nodes to ways that reference them.
     def attach_tagged_nodes_to_ways(self):
         # status output
@@ -348,13 +813,7 @@ class WayCollector(osmium.SimpleHandler):
         self.log("{} collections will have tagged nodes added '.' is 1% complete".format(total))
 
         for collection in self.collections:
-            for way in collection['ways']:
-                for j, ref in enumerate(way['refs']):
-                    if ref in self.tagged_nodes:
-                        # Add the node to the way.
-                        way['nodes'][ref] = self.tagged_nodes[ref]
-                        # Add the ref to the coords tuple to associate it.
-                        way['coords'][j] = (way['coords'][j][0], way['coords'][j][1], ref)
+            self.attach_tagged_nodes_to_collection(collection)
 
             # status output
             if self.verbose:
@@ -369,3 +828,46 @@ class WayCollector(osmium.SimpleHandler):
         # status output
         if self.verbose:
             self.log('\nAdding tagged nodes completed in {time:.1f} seconds'.format(time=(time.time() - start_time)))
+
+    # Attach tagged nodes to the ways of a collection that reference them.
+    def attach_tagged_nodes_to_collection(self, collection):
+        for way in collection['ways']:
+            for ref in way['refs']:
+                if ref in self.tagged_nodes:
+                    # Add the node to the way.
+                    way['nodes'][ref] = self.tagged_nodes[ref]
+
+# Pack a location given in OSM's fixed-point format (integer 1e-7 degrees) into
+# a single 64-bit integer, the latitude in the high 32 bits and the longitude in
+# the low 32 bits. Packing both into one value allows lists of coordinates to
+# be reversed and sliced like any other array.
+def pack_location(y, x):
+    return (y << 32) | (x & 0xFFFFFFFF)
+
+# Unpack a location packed with pack_location() into a (lat, lon) tuple.
+def unpack_location(packed):
+    x = packed & 0xFFFFFFFF
+    if x & 0x80000000:
+        x = x - 0x100000000
+    return ((packed >> 32) / 10000000, x / 10000000)
+
+# Passes nodes to a collector's node handler.
+class NodeHandler(object):
+    def __init__(self, collector):
+        self.node = collector.node
+
+# Adds the nodes referenced by ways to an osmium.IdTracker.
+class NodeReferenceTracker(object):
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def way(self, way):
+        self.tracker.add_references(way)
+
+# The collector and routes shared with forked worker processes while joining.
+forked_collector = None
+forked_routes = None
+
+# Plan the joins for a single route in a worker process.
+def plan_route_joins_in_worker(i):
+    return forked_collector.plan_route_joins(forked_routes[i]['ways'])
@@ -1,3 +1,4 @@
+import ast
 import re
 
 class And(object):
@@ -156,3 +157,240 @@ class Id(WayMatcher):
 
     def match_way(self, way):
         return way['id'] in self.ids
+
+# The matchers that may be used in match expressions.
+MATCHERS = {
+    'And': And,
+    'Or': Or,
+    'Not': Not,
+    'TagEmpty': TagEmpty,
+    'TagEquals': TagEquals,
+    'TagContains': TagContains,
+    'TagRegex': TagRegex,
+    'TagAndValueRegex': TagAndValueRegex,
+    'Id': Id,
+}
+
+# Parse a match expression such as
+#   'And(TagEquals("highway", "service"), TagEquals("access", "private"))'
+# into a tree of matchers.
+#
+# Only calls to the matchers above with literal arguments (strings, numbers,
+# re flags such as re.IGNORECASE and other calls) are allowed, so unlike eval()
+# no other code can be run.
+def parse_match_expression(match_expression):
+    try:
+        tree = ast.parse(match_expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('Invalid match expression: {}'.format(e))
+    return build_matcher(tree.body, match_expression)
+
+def build_matcher(node, match_expression):
+    if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name) or node.func.id not in MATCHERS:
+        raise ValueError('Match expressions may only contain calls to {}. Received {}'.format(', '.join(MATCHERS), match_expression))
+    args = [build_argument(arg, match_expression) for arg in node.args]
+    kwargs = {keyword.arg: build_argument(keyword.value, match_expression) for keyword in node.keywords}
+    if None in kwargs:
+        raise ValueError('Invalid argument in match expression {}'.format(match_expression))
+    try:
+        return MATCHERS[node.func.id](*args, **kwargs)
+    except TypeError as e:
+        raise ValueError('Invalid arguments for {}: {}'.format(node.func.id, e))
+
+def build_argument(node, match_expression):
+    if isinstance(node, ast.Call):
+        return build_matcher(node, match_expression)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int)):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant) and isinstance(node.operand.value, int):
+        return -node.operand.value
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 're' and isinstance(getattr(re, node.attr, None), re.RegexFlag):
+        return getattr(re, node.attr)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr):
+        return build_argument(node.left, match_expression) | build_argument(node.right, match_expression)
+    raise ValueError('Invalid argument in match expression {}'.format(match_expression))
+
+# Compile a match expression (a string or a tree of matchers) into a
+# CompiledMatch.
+#
+# Rather than walking the tree of matchers for every way, the tree is flattened
+# into a single Python expression that is compiled once:
+#
+#  - Nested And and Or terms are merged into their parents.
+#  - TagEquals terms on the same tag in an Or become a single lookup of the tag's
+#    value in a set.
+#  - TagRegex terms with the same flags and no groups in an Or are combined into
+#    one regex, so the tag keys are only scanned once.
+#
+# The result matches exactly the same ways and collections as the tree itself.
+# The compiled functions can't be pickled, so a CompiledMatch is pickled as its
+# tree of matchers and compiled again when it is unpickled.
+def compile_match(match_expression):
+    if isinstance(match_expression, str):
+        match_expression = parse_match_expression(match_expression)
+    try:
+        if not callable(match_expression.match):
+            raise ValueError('match expression must support a "match" method.')
+    except AttributeError:
+        raise ValueError('match expression must support a "match" method.')
+    return CompiledMatch(match_expression)
+
+class CompiledMatch(object):
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.match_way = MatchCompiler().compile_way_predicate(expression)
+        self.match_collection = MatchCompiler().compile_collection_predicate(expression)
+
+    def match(self, way_or_collection):
+        if 'ways' in way_or_collection:
+            return self.match_collection(way_or_collection)
+        else:
+            return self.match_way(way_or_collection)
+
+    def __reduce__(self):
+        return (CompiledMatch, (self.expression,))
+
+def any_key_matches(match, tags):
+    for key in tags:
+        if match(key):
+            return True
+    return False
+
+def any_key_and_value_match(key_match, value_match, tags):
+    for key, value in tags.items():
+        if key_match(key) and value_match(value):
+            return True
+    return False
+
+def any_way_matches(match_way, collection):
+    if not 'ways' in collection:
+        raise ValueError('Collections must be a dict with a "ways" key. Received {}'.format(collection))
+    for way in collection['ways']:
+        if match_way(way):
+            return True
+    return False
+
+def check_way_has_tags(way):
+    if 'tags' not in way:
+        raise ValueError('Ways must be a dict with a "tags" key. Received {}'.format(way))
+    return True
+
+# Inline global flags can't be used in a combined regex. Patterns with groups
+# aren't combined either, as references to their groups by number (such as
+# \1 or (?(1)...)) would refer to the groups of the other patterns.
+unsafe_to_combine = re.compile(r'\(\?[aiLmsux]+\)')
+
+class MatchCompiler(object):
+
+    def __init__(self):
+        self.namespace = {
+            'any_key_matches': any_key_matches,
+            'any_key_and_value_match': any_key_and_value_match,
+            'any_way_matches': any_way_matches,
+            'check_way_has_tags': check_way_has_tags,
+        }
+
+    # Store a value used by the compiled code and return its name.
+    def constant(self, value):
+        name = 'c{}'.format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def build_function(self, argument, source):
+        code = 'lambda {}: {}'.format(argument, source)
+        return eval(compile(code, '<match expression>', 'eval'), self.namespace)
+
+    def compile_way_predicate(self, expression):
+        return self.build_function('way', self.way_source(expression))
+
+    # Collections match the terms of an And or a Not as a whole, the other
+    # matchers match if any of the ways in the collection match.
+    def compile_collection_predicate(self, expression):
+        return self.build_function('collection', self.collection_source(expression))
+
+    def collection_source(self, expression):
+        if type(expression) in (And, Or, Not) and not self.matches_any_way(expression):
+            if isinstance(expression, Not):
+                return '(not {})'.format(self.collection_source(expression.term))
+            operator = ' or ' if isinstance(expression, Or) else ' and '
+            return '({})'.format(operator.join(self.collection_source(term) for term in self.flatten(expression)))
+        if type(expression) not in MATCHERS.values():
+            return '{}.match(collection)'.format(self.constant(expression))
+        return 'any_way_matches({}, collection)'.format(self.constant(self.compile_way_predicate(expression)))
+
+    # Whether a collection matches the expression exactly when any of its ways
+    # do. This holds for the way matchers and Ors of them.
+    def matches_any_way(self, expression):
+        if isinstance(expression, Or):
+            return all(self.matches_any_way(term) for term in expression.terms)
+        return type(expression) in MATCHERS.values() and not isinstance(expression, (And, Not))
+
+    # Flatten nested terms of the same kind into a single list.
+    def flatten(self, expression):
+        terms = []
+        for term in expression.terms:
+            if type(term) == type(expression):
+                terms.extend(self.flatten(term))
+            else:
+                terms.append(term)
+        return terms
+
+    def way_source(self, expression):
+        if isinstance(expression, Not):
+            return '(not {})'.format(self.way_source(expression.term))
+        if isinstance(expression, Or):
+            return '({})'.format(' or '.join(self.or_sources(self.flatten(expression))))
+        if isinstance(expression, And):
+            return '({})'.format(' and '.join(self.way_source(term) for term in self.flatten(expression)))
+        if type(expression) == TagEmpty:
+            return "({tag} not in way['tags'] or way['tags'][{tag}] == '')".format(tag=self.constant(expression.tag))
+        if type(expression) == TagEquals:
+            return "(check_way_has_tags(way) and way['tags'].get({}) == {})".format(self.constant(expression.tag), self.constant(expression.value))
+        if type(expression) == TagContains:
+            return "(check_way_has_tags(way) and {tag} in way['tags'] and {} in way['tags'][{tag}])".format(self.constant(expression.value), tag=self.constant(expression.tag))
+        if type(expression) == TagRegex:
+            return "any_key_matches({}, way['tags'])".format(self.constant(expression.regex.match))
+        if type(expression) == TagAndValueRegex:
+            return "any_key_and_value_match({}, {}, way['tags'])".format(self.constant(expression.tag_regex.match), self.constant(expression.value_regex.match))
+        if type(expression) == Id:
+            return "(way['id'] in {})".format(self.constant(expression.ids))
+        return '{}.match_way(way)'.format(self.constant(expression))
+
+    # The sources of the terms of an Or, with TagEquals terms on the same tag
+    # and TagRegex terms with the same flags combined.
+    def or_sources(self, terms):
+        sources = []
+        values_by_tag = {}
+        regexes_by_flags = {}
+        for term in terms:
+            if type(term) == TagEquals:
+                if term.tag not in values_by_tag:
+                    values_by_tag[term.tag] = []
+                    sources.append(('equals', term.tag))
+                values_by_tag[term.tag].append(term.value)
+            elif type(term) == TagRegex and not term.regex.groups and not unsafe_to_combine.search(term.regex.pattern):
+                if term.regex.flags not in regexes_by_flags:
+                    regexes_by_flags[term.regex.flags] = []
+                    sources.append(('regex', term.regex.flags))
+                regexes_by_flags[term.regex.flags].append(term.regex)
+            else:
+                sources.append(('source', self.way_source(term)))
+        return [self.or_source(kind, key, values_by_tag, regexes_by_flags) for kind, key in sources]
+
+    def or_source(self, kind, key, values_by_tag, regexes_by_flags):
+        if kind == 'equals':
+            values = values_by_tag[key]
+            if len(values) == 1:
+                return self.way_source(TagEquals(key, values[0]))
+            return "(check_way_has_tags(way) and way['tags'].get({}) in {})".format(self.constant(key), self.constant(frozenset(values)))
+        if kind == 'regex':
+            regexes = regexes_by_flags[key]
+            if len(regexes) > 1:
+                try:
+                    combined = re.compile('|'.join('(?:{})'.format(regex.pattern) for regex in regexes), key)
+                    return "any_key_matches({}, way['tags'])".format(self.constant(combined.match))
+                except re.error:
+                    pass
+            return ' or '.join("any_key_matches({}, way['tags'])".format(self.constant(regex.match)) for regex in regexes)
+        return key
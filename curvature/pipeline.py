@@ -0,0 +1,111 @@
+import importlib
+import multiprocessing
+from collections import deque
+from functools import reduce
+from itertools import islice
+
+# The argument that separates the stages of a pipeline given on the command line.
+STAGE_SEPARATOR = '--'
+
+# Split a list of arguments into the arguments of each stage.
+#
+# Example:
+#   ['add_segments', '--', 'head', '-n', '10']
+# becomes:
+#   [['add_segments'], ['head', '-n', '10']]
+def split_stages(argv):
+    stages = [[]]
+    for arg in argv:
+        if arg == STAGE_SEPARATOR:
+            stages.append([])
+        else:
+            stages[-1].append(arg)
+    for stage in stages:
+        if not stage:
+            raise ValueError('Each stage must start with the name of a post-processor.')
+    return stages
+
+# Load a post-processor by its module name, such as 'filter_out_ways', and
+# configure it with its arguments.
+def load_post_processor(module_name, argv):
+    class_name = ''.join(map(str.capitalize, module_name.split('.').pop().split('_')))
+    mod = importlib.import_module('curvature.post_processors.' + module_name)
+    fl = getattr(mod, class_name)
+    return fl.parse(argv)
+
+# Load the post-processors of each stage given on the command line.
+def load_post_processors(argv):
+    return [load_post_processor(stage[0], stage[1:]) for stage in split_stages(argv)]
+
+# Chain post-processors so that each processes the output of the one before.
+def chain_post_processors(iterable, post_processors):
+    return reduce(lambda acc, processor: processor.process(acc), post_processors, iterable)
+
+# Run a chain of post-processors, processing collections in multiple processes.
+#
+# Runs of consecutive post-processors that mark themselves as `per_collection`
+# (that is, that process each collection on its own without regard to the
+# others) are run in a pool of worker processes. Collections are sent to the
+# workers in batches of batch_size and their results are put back in the order
+# of their input. At most max_in_flight batches are sent out at any time so that
+# a slow consumer doesn't cause the whole stream to be read into memory.
+#
+# Other post-processors, such as sorts and those which keep state between
+# collections, are run in this process on the reassembled stream and act as
+# barriers between the parallel runs.
+#
+# Workers are forked so that they inherit our post-processors rather than
+# re-importing the program that runs them. Where fork isn't available the
+# post-processors are run in this process.
+def run_post_processors(iterable, post_processors, jobs=1, batch_size=100, max_in_flight=None):
+    if jobs < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+        return chain_post_processors(iterable, post_processors)
+    if max_in_flight is None:
+        max_in_flight = jobs * 4
+    for stage in group_stages(post_processors):
+        if stage[0]:
+            iterable = process_in_parallel(iterable, stage[1], jobs, batch_size, max_in_flight)
+        else:
+            iterable = chain_post_processors(iterable, stage[1])
+    return iterable
+
+# Group post-processors into runs of (per_collection, [post_processors]).
+def group_stages(post_processors):
+    stages = []
+    for post_processor in post_processors:
+        per_collection = getattr(post_processor, 'per_collection', False)
+        if stages and stages[-1][0] == per_collection:
+            stages[-1][1].append(post_processor)
+        else:
+            stages.append((per_collection, [post_processor]))
+    return stages
+
+def process_in_parallel(iterable, post_processors, jobs, batch_size, max_in_flight):
+    iterator = iter(iterable)
+    pool = multiprocessing.get_context('fork').Pool(jobs, initializer=init_worker, initargs=(post_processors,))
+    try:
+        in_flight = deque()
+        while True:
+            # Keep our window of batches full.
+            while len(in_flight) < max_in_flight:
+                batch = list(islice(iterator, batch_size))
+                if not batch:
+                    break
+                in_flight.append(pool.apply_async(process_batch, (batch,)))
+            if not in_flight:
+                break
+            for collection in in_flight.popleft().get():
+                yield(collection)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+worker_post_processors = None
+
+def init_worker(post_processors):
+    global worker_post_processors
+    worker_post_processors = post_processors
+
+def process_batch(batch):
+    return list(chain_post_processors(batch, worker_post_processors))
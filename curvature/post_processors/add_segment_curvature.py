@@ -1,7 +1,13 @@
 # -*- coding: UTF-8 -*-
 import argparse
+try:
+    import numpy
+    from curvature import vectormath
+except ImportError:
+    numpy = None
 
 class AddSegmentCurvature(object):
+    per_collection = True
 
     level_1_max_radius = 175
     level_1_weight = 1
@@ -12,7 +18,9 @@ class AddSegmentCurvature(object):
     level_4_max_radius = 30
     level_4_weight = 2
 
-    def __init__(self, l1maxr=175, l2maxr=100, l3maxr=60, l4maxr=30, l1weight=1, l2weight=1.3, l3weight=1.6, l4weight=2):
+    # If vectorized is None, the vectorized calculations will be used if NumPy
+    # is available.
+    def __init__(self, l1maxr=175, l2maxr=100, l3maxr=60, l4maxr=30, l1weight=1, l2weight=1.3, l3weight=1.6, l4weight=2, vectorized=None):
         self.level_1_max_radius = l1maxr
         self.level_1_weight = l1weight
         self.level_2_max_radius = l2maxr
@@ -21,6 +29,11 @@ class AddSegmentCurvature(object):
         self.level_3_weight = l3weight
         self.level_4_max_radius = l4maxr
         self.level_4_weight = l4weight
+        if vectorized is None:
+            vectorized = numpy is not None
+        elif vectorized and numpy is None:
+            raise ValueError('NumPy is required for vectorized calculations.')
+        self.vectorized = vectorized
 
     @classmethod
     def parse(cls, argv):
@@ -33,8 +46,13 @@ class AddSegmentCurvature(object):
         parser.add_argument('--l2weight', type=float, default=1.3, help='The weight to multiply medium-broad curve lengths by.')
         parser.add_argument('--l3weight', type=float, default=1.6, help='The weight to multiply medium-sharp curve lengths by.')
         parser.add_argument('--l4weight', type=float, default=2, help='The weight to multiply sharp curve lengths by.')
+        parser.add_argument('--scalar', action='store_true', help='Classify each segment in turn rather than using the NumPy-vectorized calculations.')
         args = parser.parse_args(argv)
-        return cls(args.l1maxr, args.l2maxr, args.l3maxr, args.l4maxr, args.l1weight, args.l2weight, args.l3weight, args.l4weight)
+        if args.scalar:
+            vectorized = False
+        else:
+            vectorized = None
+        return cls(args.l1maxr, args.l2maxr, args.l3maxr, args.l4maxr, args.l1weight, args.l2weight, args.l3weight, args.l4weight, vectorized)
 
     def process(self, iterable):
         for collection in iterable:
@@ -42,10 +60,31 @@ class AddSegmentCurvature(object):
             for way in collection['ways']:
                 if 'segments' not in way:
                     raise ValueError('Required "segments" not found in way. Add them with `curvature-pp add_segments` before using this processor.')
-                for segment in way['segments']:
-                    self.add_curvature_to_segment(segment)
+                if self.vectorized:
+                    all_segments.extend(way['segments'])
+                else:
+                    for segment in way['segments']:
+                        self.add_curvature_to_segment(segment)
+            if all_segments:
+                self.add_curvature_to_segments_vectorized(all_segments)
             yield(collection)
 
+    # Equivalent to add_curvature_to_segment() for each of the segments, but
+    # classifying all of the segments at once.
+    def add_curvature_to_segments_vectorized(self, segments):
+        try:
+            lengths = numpy.fromiter((segment['length'] for segment in segments), float, len(segments))
+            radii = numpy.fromiter((segment['radius'] for segment in segments), float, len(segments))
+        except KeyError:
+            raise ValueError('Required "length" or "radius" not found in segment. Add them with `curvature-pp add_segment_length_and_radii` before using this processor.')
+        levels, curvatures = self.classify_curvature(lengths, radii)
+        for segment, level, curvature in zip(segments, levels.tolist(), curvatures.tolist()):
+            segment['curvature_level'] = level
+            if level:
+                segment['curvature'] = curvature
+            else:
+                segment['curvature'] = 0
+
     def add_curvature_to_segment(self, segment):
         if 'length' not in segment or 'radius' not in segment:
             raise ValueError('Required "length" or "radius" not found in segment. Add them with `curvature-pp add_segment_length_and_radii` before using this processor.')
@@ -64,3 +103,10 @@ class AddSegmentCurvature(object):
         else:
             segment['curvature_level'] = 0
             segment['curvature'] =  0
+
+    # Return arrays of the curvature levels and curvatures for arrays of
+    # segment lengths and radii.
+    def classify_curvature(self, lengths, radii):
+        return vectormath.classify_curvature(lengths, radii,
+            [self.level_1_max_radius, self.level_2_max_radius, self.level_3_max_radius, self.level_4_max_radius],
+            [self.level_1_weight, self.level_2_weight, self.level_3_weight, self.level_4_weight])
@@ -3,12 +3,35 @@ import math
 from curvature.geomath import distance_on_earth
 from curvature.radiusmath import circum_circle_radius
 import itertools
+import argparse
+try:
+    import numpy
+    from curvature import vectormath
+except ImportError:
+    numpy = None
 
 class AddSegmentLengthAndRadius(object):
+    per_collection = True
+
     MAX_RADIUS = 10000
 
+    # If vectorized is None, the vectorized calculations will be used if NumPy
+    # is available. See curvature.vectormath for how their results compare to
+    # the (reference) scalar calculations.
+    def __init__(self, vectorized=None):
+        if vectorized is None:
+            vectorized = numpy is not None
+        elif vectorized and numpy is None:
+            raise ValueError('NumPy is required for vectorized calculations.')
+        self.vectorized = vectorized
+
     @classmethod
     def parse(cls, argv):
+        parser = argparse.ArgumentParser(prog='add_segment_length_and_radius', description='Add the length and radius to each segment.')
+        parser.add_argument('--scalar', action='store_true', help='Calculate each segment in turn rather than using the NumPy-vectorized calculations.')
+        args = parser.parse_args(argv)
+        if args.scalar:
+            return cls(vectorized=False)
         return cls()
 
     def process(self, iterable):
@@ -16,8 +39,11 @@ class AddSegmentLengthAndRadius(object):
             if 'segments' not in collection['ways'][0]:
                 raise ValueError('Required "segments" not found in way. Add them with `curvature-pp add_segments` before using this processor.')
             all_segments = list(itertools.chain(*map(lambda way: way['segments'], collection['ways'])))
-            self.calculate_length(all_segments)
-            self.calculate_segment_radii(all_segments)
+            if self.vectorized:
+                self.calculate_length_and_radii_vectorized(all_segments)
+            else:
+                self.calculate_length(all_segments)
+                self.calculate_segment_radii(all_segments)
             yield(collection)
 
     def calculate_length(self, segments):
@@ -59,3 +85,18 @@ class AddSegmentLengthAndRadius(object):
             else:
                 if segment['radius'] > AddSegmentLengthAndRadius.MAX_RADIUS:
                     segment['radius'] = AddSegmentLengthAndRadius.MAX_RADIUS
+
+    # Equivalent to calculate_length() followed by calculate_segment_radii(),
+    # but calculating all of the lengths and radii of the segments at once.
+    def calculate_length_and_radii_vectorized(self, segments):
+        num_segments = len(segments)
+        if not num_segments:
+            return
+        start_lat = numpy.fromiter((segment['start'][0] for segment in segments), float, num_segments)
+        start_lon = numpy.fromiter((segment['start'][1] for segment in segments), float, num_segments)
+        end_lat = numpy.fromiter((segment['end'][0] for segment in segments), float, num_segments)
+        end_lon = numpy.fromiter((segment['end'][1] for segment in segments), float, num_segments)
+        lengths, radii = vectormath.segment_lengths_and_radii(start_lat, start_lon, end_lat, end_lon, AddSegmentLengthAndRadius.MAX_RADIUS)
+        for segment, length, radius in zip(segments, lengths.tolist(), radii.tolist()):
+            segment['length'] = length
+            segment['radius'] = radius
@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 
 class AddSegments(object):
+    per_collection = True
 
     @classmethod
     def parse(cls, argv):
@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+import argparse
+from curvature.post_processors.add_segment_length_and_radius import AddSegmentLengthAndRadius
+from curvature.post_processors.add_segment_curvature import AddSegmentCurvature
+try:
+    import numpy
+    from curvature import vectormath
+except ImportError:
+    numpy = None
+
+# Equivalent to running the add_segments, add_segment_length_and_radius, and
+# add_segment_curvature post-processors in turn, but building the segments of
+# each collection with all of their values at once.
+class AddSegmentsAndCurvature(object):
+    per_collection = True
+
+    def __init__(self, l1maxr=175, l2maxr=100, l3maxr=60, l4maxr=30, l1weight=1, l2weight=1.3, l3weight=1.6, l4weight=2, vectorized=None):
+        self.length_and_radius = AddSegmentLengthAndRadius(vectorized)
+        self.curvature = AddSegmentCurvature(l1maxr, l2maxr, l3maxr, l4maxr, l1weight, l2weight, l3weight, l4weight, vectorized)
+        self.vectorized = self.length_and_radius.vectorized
+
+    @classmethod
+    def parse(cls, argv):
+        parser = argparse.ArgumentParser(prog='add_segments_and_curvature', description='Add segments with their length, radius, and weighted curvature values to each way. The same as add_segments, add_segment_length_and_radius, and add_segment_curvature.')
+        parser.add_argument('--l1maxr', type=int, default=175, help='The maximum radius to be considered a broad curve.')
+        parser.add_argument('--l2maxr', type=int, default=100, help='The maximum radius to be considered a medium-broad curve.')
+        parser.add_argument('--l3maxr', type=int, default=60, help='The maximum radius to be considered a medium-sharp curve.')
+        parser.add_argument('--l4maxr', type=int, default=30, help='The maximum radius to be considered a sharp curve.')
+        parser.add_argument('--l1weight', type=float, default=1, help='The weight to multiply broad curve lengths by.')
+        parser.add_argument('--l2weight', type=float, default=1.3, help='The weight to multiply medium-broad curve lengths by.')
+        parser.add_argument('--l3weight', type=float, default=1.6, help='The weight to multiply medium-sharp curve lengths by.')
+        parser.add_argument('--l4weight', type=float, default=2, help='The weight to multiply sharp curve lengths by.')
+        parser.add_argument('--scalar', action='store_true', help='Calculate each segment in turn rather than using the NumPy-vectorized calculations.')
+        args = parser.parse_args(argv)
+        if args.scalar:
+            vectorized = False
+        else:
+            vectorized = None
+        return cls(args.l1maxr, args.l2maxr, args.l3maxr, args.l4maxr, args.l1weight, args.l2weight, args.l3weight, args.l4weight, vectorized)
+
+    def process(self, iterable):
+        for collection in iterable:
+            if self.vectorized:
+                self.add_segments_vectorized(collection)
+            else:
+                self.add_segments(collection)
+            yield(collection)
+
+    def add_segments(self, collection):
+        all_segments = []
+        for way in collection['ways']:
+            coords = way['coords']
+            way['segments'] = [{'start': coords[i], 'end': coords[i + 1]} for i in range(len(coords) - 1)]
+            all_segments.extend(way['segments'])
+        self.length_and_radius.calculate_length(all_segments)
+        self.length_and_radius.calculate_segment_radii(all_segments)
+        for segment in all_segments:
+            self.curvature.add_curvature_to_segment(segment)
+
+    def add_segments_vectorized(self, collection):
+        # The segments of all ways run from each coordinate to the next.
+        starts = []
+        ends = []
+        for way in collection['ways']:
+            coords = way['coords']
+            starts.extend(coords[:-1])
+            ends.extend(coords[1:])
+        num_segments = len(starts)
+        if num_segments:
+            start_lat = numpy.fromiter((coord[0] for coord in starts), float, num_segments)
+            start_lon = numpy.fromiter((coord[1] for coord in starts), float, num_segments)
+            end_lat = numpy.fromiter((coord[0] for coord in ends), float, num_segments)
+            end_lon = numpy.fromiter((coord[1] for coord in ends), float, num_segments)
+            lengths, radii = vectormath.segment_lengths_and_radii(start_lat, start_lon, end_lat, end_lon, AddSegmentLengthAndRadius.MAX_RADIUS)
+            levels, curvatures = self.curvature.classify_curvature(lengths, radii)
+            values = zip(starts, ends, lengths.tolist(), radii.tolist(), levels.tolist(), curvatures.tolist())
+        else:
+            values = iter(())
+
+        for way in collection['ways']:
+            way['segments'] = []
+            for i in range(len(way['coords']) - 1):
+                start, end, length, radius, level, curvature = next(values)
+                if not level:
+                    curvature = 0
+                way['segments'].append({
+                    'start': start,
+                    'end': end,
+                    'length': length,
+                    'radius': radius,
+                    'curvature_level': level,
+                    'curvature': curvature,
+                })
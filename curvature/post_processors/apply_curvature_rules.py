@@ -0,0 +1,126 @@
+# -*- coding: UTF-8 -*-
+import argparse
+import shlex
+from curvature.pipeline import load_post_processor
+from curvature.collection_tools import SquashCurvatureNearbyProcessorAbstract
+from curvature.collection_tools import InflateCurvatureNearbyProcessorAbstract
+from curvature.collection_tools import CollectionSegmentIndex
+from curvature.post_processors.squash_curvature_for_tagged_ways import SquashCurvatureForTaggedWays
+from curvature.post_processors.squash_curvature_for_ways import SquashCurvatureForWays
+from curvature.post_processors.inflate_curvature_for_tagged_ways import InflateCurvatureForTaggedWays
+from curvature.post_processors.inflate_curvature_for_ways import InflateCurvatureForWays
+
+# Apply the rules of several squash_curvature_xxxx and inflate_curvature_xxxx
+# post-processors in one pass over each collection.
+#
+# Each rule is given as the name of the post-processor followed by its
+# arguments, just as they would be given to curvature-pp. For example:
+#
+#   squash_curvature_for_tagged_ways --tag junction --values 'roundabout,circular'
+#   squash_curvature_near_tagged_nodes --tag barrier --distance 30
+#
+# The result is the same as running the post-processors in turn: the segments
+# and ways that each rule applies to are found first (which doesn't depend on
+# their curvature), then the changes of each rule are applied to them in the
+# order of the rules.
+class ApplyCurvatureRules(object):
+    per_collection = True
+
+    def __init__(self, rules):
+        for rule in rules:
+            if not isinstance(rule, (SquashCurvatureNearbyProcessorAbstract, InflateCurvatureNearbyProcessorAbstract, SquashCurvatureForTaggedWays, SquashCurvatureForWays, InflateCurvatureForTaggedWays, InflateCurvatureForWays)):
+                raise ValueError('{} is not a squash_curvature_xxxx or inflate_curvature_xxxx post-processor.'.format(type(rule).__name__))
+        self.rules = rules
+
+    @classmethod
+    def parse(cls, argv):
+        parser = argparse.ArgumentParser(prog='apply_curvature_rules', description='Apply the rules of several squash_curvature_xxxx and inflate_curvature_xxxx post-processors at once.')
+        parser.add_argument('--rule', type=str, action='append', default=[], help='A post-processor and its arguments. Example: \'squash_curvature_near_tagged_nodes --tag barrier --distance 30\'. May be given multiple times.')
+        parser.add_argument('--rules', type=argparse.FileType('r'), action='append', default=[], help='A file with one rule on each line. Empty lines and lines starting with \'#\' are ignored.')
+        args = parser.parse_args(argv)
+        rules = []
+        for file in args.rules:
+            rules.extend(cls.read_rules(file))
+            file.close()
+        rules.extend(args.rule)
+        if not rules:
+            parser.error('At least one --rule or --rules file is required.')
+        return cls([cls.load_rule(rule) for rule in rules])
+
+    @classmethod
+    def read_rules(cls, file):
+        rules = []
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rules.append(line)
+        return rules
+
+    @classmethod
+    def load_rule(cls, rule):
+        argv = shlex.split(rule)
+        return load_post_processor(argv[0], argv[1:])
+
+    def process(self, iterable):
+        for collection in iterable:
+            yield(self.process_collection(collection))
+
+    def process_collection(self, collection):
+        # The rules to apply to each segment, keyed by the segment's id.
+        segment_rules = {}
+        # The rules to apply to the totals of each way, keyed by the way's index.
+        way_rules = {}
+        # An index of the segments by distance, shared by the nearby rules.
+        index = CollectionSegmentIndex(collection)
+        for rule in self.rules:
+            if isinstance(rule, (SquashCurvatureNearbyProcessorAbstract, InflateCurvatureNearbyProcessorAbstract)):
+                for segment, count in index.count_segments_nearby(rule.find_initial_segments(collection), rule.distance):
+                    # Squashing more than once has no further effect.
+                    if self.is_squash_rule(rule):
+                        count = 1
+                    segment_rules.setdefault(id(segment), (segment, []))[1].extend([rule] * count)
+            else:
+                for i, way in enumerate(collection['ways']):
+                    if rule.way_matches(way):
+                        way_rules.setdefault(i, []).append(rule)
+                        for segment in way['segments']:
+                            segment_rules.setdefault(id(segment), (segment, []))[1].append(rule)
+
+        for segment, rules in segment_rules.values():
+            for rule in rules:
+                if self.is_squash_rule(rule):
+                    self.squash_segment_curvature(segment)
+                else:
+                    self.inflate_segment_curvature(segment, rule.curvature)
+        for i, rules in way_rules.items():
+            way = collection['ways'][i]
+            for rule in rules:
+                if self.is_squash_rule(rule):
+                    if 'curvature' in way:
+                        way['curvature'] = 0
+                else:
+                    total_added = max(len(way['segments']) * rule.curvature, rule.curvature)
+                    if 'curvature' in way:
+                        way['curvature'] = way['curvature'] + total_added
+                    else:
+                        way['curvature'] = total_added
+        return collection
+
+    def is_squash_rule(self, rule):
+        return isinstance(rule, (SquashCurvatureNearbyProcessorAbstract, SquashCurvatureForTaggedWays, SquashCurvatureForWays))
+
+    # Squash the curvature values on a single segment.
+    def squash_segment_curvature(self, segment):
+        if 'curvature' in segment:
+            segment['curvature'] = 0
+        if 'curvature_level' in segment:
+            segment['curvature_level'] = 0
+
+    # Inflate the curvature values on a single segment.
+    def inflate_segment_curvature(self, segment, curvature):
+        if 'curvature' in segment:
+            segment['curvature'] = segment['curvature'] + curvature
+        else:
+            segment['curvature'] = curvature
+        if 'curvature_level' in segment and segment['curvature_level'] < 4:
+            segment['curvature_level'] = segment['curvature_level'] + 1
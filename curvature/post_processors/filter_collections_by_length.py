@@ -2,6 +2,8 @@
 import argparse
 
 class FilterCollectionsByLength(object):
+    per_collection = True
+
     def __init__(self, min=None, max=None):
         self.min = min
         self.max = max
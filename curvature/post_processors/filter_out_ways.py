@@ -1,22 +1,13 @@
 # -*- coding: UTF-8 -*-
 import argparse
 from curvature.collection_tools import CollectionSplitter
-from curvature.match import And
-from curvature.match import Or
-from curvature.match import Not
-from curvature.match import TagEmpty
-from curvature.match import TagEquals
-from curvature.match import TagContains
-from curvature.match import Id
+from curvature.match import compile_match
 
 class FilterOutWays(CollectionSplitter):
+    per_collection = True
+
     def __init__(self, match_expression):
-        self.match_expression = eval(match_expression)
-        try:
-            if not callable(self.match_expression.match):
-                raise ValueError('match expression must support a "match" method.')
-        except AttributeError:
-            raise ValueError('match expression must support a "match" method.')
+        self.match_expression = compile_match(match_expression)
 
     @classmethod
     def parse(cls, argv):
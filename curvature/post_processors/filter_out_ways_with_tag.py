@@ -3,6 +3,8 @@ import argparse
 from curvature.collection_tools import CollectionSplitter
 
 class FilterOutWaysWithTag(CollectionSplitter):
+    per_collection = True
+
     def __init__(self, tag=None, values=None, filter_out_ways_missing_tag=False):
         self.tag = tag
         self.values = values
@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+import argparse
+from curvature.collection_tools import CollectionSplitter
+
+# Filter out ways that match any of several tag rules in a single pass.
+#
+# Each rule is given as 'tag=value1,value2' and filters out ways where the tag
+# has one of the values listed, the same as filter_out_ways_with_tag. Collections
+# are split exactly as if a filter_out_ways_with_tag stage had been run for each
+# rule in turn.
+class FilterOutWaysWithTags(CollectionSplitter):
+    per_collection = True
+
+    def __init__(self, rules):
+        # The values to filter out, keyed by tag.
+        self.values_by_tag = {}
+        for tag, values in rules:
+            self.values_by_tag.setdefault(tag, set()).update(values)
+
+    @classmethod
+    def parse(cls, argv):
+        parser = argparse.ArgumentParser(prog='filter_out_ways_with_tags', description='Filter out ways that have any of the tag values listed.')
+        parser.add_argument('--rule', type=cls.parse_rule, action='append', required=True, help='A tag and the values to filter out when found. Example: \'surface=unpaved,dirt,gravel\'. May be given multiple times.')
+        args = parser.parse_args(argv)
+        return cls(args.rule)
+
+    @classmethod
+    def parse_rule(cls, rule):
+        tag, separator, values = rule.partition('=')
+        if not tag or not separator or not values:
+            raise argparse.ArgumentTypeError('Rules must be in the form \'tag=value1,value2\'. Received \'{}\''.format(rule))
+        return (tag, values.split(','))
+
+    def process(self, iterable):
+        for collection in iterable:
+            result_collection = self.create_result_collection(collection)
+            for way in collection['ways']:
+                # If we've hit a matching way, yield any previous results and start a new collection.
+                # No need to yield anything if we don't have any previous results.
+                if self.way_matches(way):
+                    if result_collection['ways']:
+                        yield(result_collection)
+                        result_collection = self.create_result_collection(collection)
+                else:
+                    result_collection['ways'].append(way)
+
+            # Yield the remaining collection.
+            if result_collection['ways']:
+                yield(result_collection)
+
+    def way_matches(self, way):
+        values_by_tag = self.values_by_tag
+        for tag, value in way['tags'].items():
+            values = values_by_tag.get(tag)
+            if values is not None and value in values:
+                return True
+        return False
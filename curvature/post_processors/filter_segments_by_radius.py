@@ -3,6 +3,8 @@ import argparse
 from curvature.geomath import distance_on_earth
 
 class FilterSegmentsByRadius(object):
+    per_collection = True
+
     def __init__(self, min=None, max=None):
         self.min = min
         self.max = max
@@ -2,6 +2,8 @@
 import argparse
 
 class InflateCurvatureForTaggedWays(object):
+    per_collection = True
+
     def __init__(self, curvature=1, tag=None, values=None):
         self.curvature = curvature
         self.tag = tag
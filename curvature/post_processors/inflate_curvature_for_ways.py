@@ -1,24 +1,13 @@
 # -*- coding: UTF-8 -*-
 import argparse
-from curvature.match import And
-from curvature.match import Or
-from curvature.match import Not
-from curvature.match import TagEmpty
-from curvature.match import TagEquals
-from curvature.match import TagContains
-from curvature.match import TagRegex
-from curvature.match import TagAndValueRegex
-from curvature.match import Id
+from curvature.match import compile_match
 
 class InflateCurvatureForWays(object):
+    per_collection = True
+
     def __init__(self, curvature, match_expression):
         self.curvature = curvature
-        self.match_expression = eval(match_expression)
-        try:
-            if not callable(self.match_expression.match):
-                raise ValueError('match expression must support a "match" method.')
-        except AttributeError:
-            raise ValueError('match expression must support a "match" method.')
+        self.match_expression = compile_match(match_expression)
 
     @classmethod
     def parse(cls, argv):
@@ -32,7 +21,7 @@ class InflateCurvatureForWays(object):
         for collection in iterable:
             for way in collection['ways']:
                 # If we've hit a matching way, set its curvature to 0.
-                if self.match_expression.match_way(way):
+                if self.way_matches(way):
                     total_added = 0
                     for segment in way['segments']:
                         total_added = total_added + self.curvature
@@ -48,3 +37,6 @@ class InflateCurvatureForWays(object):
                     else:
                         way['curvature'] = total_added
             yield(collection)
+
+    def way_matches(self, way):
+        return self.match_expression.match_way(way)
@@ -23,14 +23,13 @@ class InflateCurvatureNearTaggedNodes(InflateCurvatureNearbyProcessorAbstract):
             values = None
         return cls(args.curvature, args.tag, values, args.distance)
 
-    def process_collection(self, collection):
+    def find_initial_segments(self, collection):
         for i, way in enumerate(collection['ways']):
             for j, segment in enumerate(way['segments']):
                 if len(segment['start']) == 3 and self.node_matches(way['nodes'][segment['start'][2]]):
-                    self.inflate_segment_curvature_nearby(collection, i, j, 'start')
+                    yield (i, j, 'start')
                 if len(segment['end']) == 3 and self.node_matches(way['nodes'][segment['end'][2]]):
-                    self.inflate_segment_curvature_nearby(collection, i, j, 'end')
-        return collection
+                    yield (i, j, 'end')
 
     def node_matches(self, node):
         if self.tag in node['tags']:
@@ -2,6 +2,8 @@
 import argparse
 
 class RemoveWayProperties(object):
+    per_collection = True
+
     def __init__(self, properties):
         self.properties = properties
 
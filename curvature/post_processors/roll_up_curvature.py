@@ -2,6 +2,8 @@
 import argparse
 
 class RollUpCurvature(object):
+    per_collection = True
+
     def __init__(self, add_to_ways=True, add_to_collections=True):
         self.add_to_ways = add_to_ways
         self.add_to_collections = add_to_collections
@@ -1,27 +1,120 @@
 # -*- coding: UTF-8 -*-
 import argparse
+import heapq
+import os
+import shutil
+import tempfile
+import msgpack
+from curvature import stream
+
 class SortCollectionsBySum(object):
-    def __init__(self, key, reverse=False):
+    def __init__(self, key, reverse=False, buffer_size=None, temp_dir=None, limit=None):
         self.reverse = reverse
         self.key = key
+        # Only output the first limit collections.
+        self.limit = limit
+        # The size in bytes of the collections to sort in memory. Beyond this,
+        # sorted runs of collections are written to files in temp_dir and merged.
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
 
     @classmethod
     def parse(cls, argv):
         parser = argparse.ArgumentParser(prog='sort_collections_by_sum', description='Sort collections in the stream by the sum of one of their values. (e.g. curvature, length)')
         parser.add_argument('--key', type=str, required=True, default='curvature', help='The key to sort on, default: curvature')
         parser.add_argument('--direction', choices=['DESC', 'ASC'], default='DESC', help='The sort direction, ASC or DESC. Default: DESC')
+        parser.add_argument('--limit', type=int, default=None, help='Only output this many collections, the same as following the sort with head -n. Only this many collections are held in memory.')
+        parser.add_argument('--buffer-size', type=int, default=None, help='The approximate amount of memory in megabytes to use for sorting. Beyond this, sorted runs of collections are written to temporary files and merged. The default is to sort all collections in memory.')
+        parser.add_argument('--temp-dir', type=str, default=None, help='The directory in which to write sorted runs. Default: the system temporary directory')
         args = parser.parse_args(argv)
         if args.direction == 'ASC':
             reverse = False
         else:
             reverse = True
 
-        return cls(args.key, reverse)
+        buffer_size = None
+        if args.buffer_size is not None:
+            buffer_size = args.buffer_size * 1024 * 1024
+        return cls(args.key, reverse, buffer_size, args.temp_dir, args.limit)
 
     def process(self, iterable):
-        collections = sorted(iterable, key=lambda c: self.sum_for_collection(c), reverse=self.reverse)
-        for collection in collections:
-            yield(collection)
+        if self.limit is not None:
+            # Keep a heap of the first collections. Like sorted(), nlargest()
+            # and nsmallest() keep collections with equal sums in input order.
+            if self.reverse:
+                collections = heapq.nlargest(self.limit, iterable, key=self.sum_for_collection)
+            else:
+                collections = heapq.nsmallest(self.limit, iterable, key=self.sum_for_collection)
+            for collection in collections:
+                yield(collection)
+        elif self.buffer_size is None:
+            collections = sorted(iterable, key=lambda c: self.sum_for_collection(c), reverse=self.reverse)
+            for collection in collections:
+                yield(collection)
+        else:
+            for collection in self.external_sort(iterable):
+                yield(collection)
+
+    # Sort collections using a bounded amount of memory.
+    #
+    # Collections are packed with msgpack and buffered along with their sums.
+    # They are unpacked with the options of our stream reader, which allow the
+    # integer refs that tagged nodes are keyed by.
+    # When the buffer is full it is sorted and written out to a file as a run.
+    # The runs are then merged. Ties are broken by the order of the input so
+    # that the output order is the same as that of sorted().
+    def external_sort(self, iterable):
+        temp_path = None
+        try:
+            runs = []
+            buffer = []
+            buffered_size = 0
+            for i, collection in enumerate(iterable):
+                packed = stream.packb(collection)
+                buffer.append((self.sort_key(collection), i, packed))
+                buffered_size += len(packed)
+                if buffered_size >= self.buffer_size:
+                    if temp_path is None:
+                        temp_path = tempfile.mkdtemp(prefix='curvature-sort-', dir=self.temp_dir)
+                    runs.append(self.write_run(buffer, os.path.join(temp_path, 'run-{}'.format(len(runs)))))
+                    buffer = []
+                    buffered_size = 0
+
+            buffer.sort()
+            if not runs:
+                for sort_key, i, packed in buffer:
+                    yield(stream.unpackb(packed))
+                return
+
+            files = [open(path, 'rb') for path in runs]
+            try:
+                records = [self.read_run(file) for file in files]
+                records.append(iter(buffer))
+                for sort_key, i, packed in heapq.merge(*records):
+                    yield(stream.unpackb(packed))
+            finally:
+                for file in files:
+                    file.close()
+        finally:
+            if temp_path is not None:
+                shutil.rmtree(temp_path, ignore_errors=True)
+
+    def sort_key(self, collection):
+        if self.reverse:
+            return -self.sum_for_collection(collection)
+        return self.sum_for_collection(collection)
+
+    # Write a sorted run of (sort_key, index, packed collection) records to a file.
+    def write_run(self, buffer, path):
+        buffer.sort()
+        with open(path, 'wb') as file:
+            for record in buffer:
+                file.write(msgpack.packb(record, use_bin_type=True))
+        return path
+
+    def read_run(self, file):
+        for sort_key, i, packed in msgpack.Unpacker(file, **stream.UNPACK_OPTIONS):
+            yield((sort_key, i, packed))
 
     def sum_for_collection(self, collection):
         # Use an already-summed value if it exists on the way.
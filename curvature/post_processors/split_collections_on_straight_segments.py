@@ -4,6 +4,7 @@ from copy import copy
 from curvature.collection_tools import CollectionSplitter
 
 class SplitCollectionsOnStraightSegments(CollectionSplitter):
+    per_collection = True
 
     # sequences of straight segments longer than this (in meters) will cause a way
     # to be split into multiple sections. If 0, ways will not be split.
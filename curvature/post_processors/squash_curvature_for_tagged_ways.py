@@ -2,6 +2,8 @@
 import argparse
 
 class SquashCurvatureForTaggedWays(object):
+    per_collection = True
+
     def __init__(self, tag=None, values=None):
         self.tag = tag
         self.values = values
@@ -27,14 +27,13 @@ class SquashCurvatureNearWayTagChange(SquashCurvatureNearbyProcessorAbstract):
             ignored_values = None
         return cls(args.tag, only_values, ignored_values, args.distance)
 
-    def process_collection(self, collection):
+    def find_initial_segments(self, collection):
         current_value = self.get_value_from_way(collection['ways'][0])
         for i, way in enumerate(collection['ways']):
             new_value = self.get_value_from_way(way)
             if new_value != current_value:
-                self.squash_segment_curvature_nearby(collection, i, 0, 'start')
+                yield (i, 0, 'start')
                 current_value = new_value
-        return collection
 
     def get_value_from_way(self, way):
         if self.tag in way['tags']:
@@ -0,0 +1,572 @@
+# Reading and writing the MessagePack stream of collections passed between
+# curvature-collect, curvature-pp and the output programs.
+#
+# By default each collection is written as-is. Writers may optionally use more
+# compact layouts, which readers convert back so that post-processors and
+# output programs always see the same collections:
+#
+#  - columnar: The segments of each way are written as parallel arrays of their
+#    values (length, radius, curvature, etc.) in a 'segment_columns' key instead
+#    of a list of dicts in 'segments'. The start and end of each segment are
+#    taken from the way's coords rather than repeated.
+#
+#  - packed_coords: The coords and refs of each way are written as binary blobs
+#    in MessagePack extension types. Coords are stored as pairs of 32-bit
+#    integers in units of 1e-7 degrees, the precision of OSM itself, and refs as
+#    differences from the ref before them. Coords that can't be stored exactly
+#    in this form are written as they are. Packed coords are only unpacked when
+#    they are used.
+#
+#  - string_table: The tag keys and values of ways and tagged nodes are replaced
+#    by lists of [key, value, key, value...] indexes into a table of strings.
+#    Strings are added to the table the first time they are used, and a
+#    collection that adds strings carries them in a 'string_table' key as
+#    [index of the first new string, [strings]]. Once the table is full, further
+#    new strings are written in place of their indexes. Readers decode the tags
+#    of every way to the same (interned) string objects.
+#
+#  - normalized: Each way and tagged node is written once, in a 'way_table' or
+#    'node_table' key of the first collection that uses it as a list of
+#    [slot, way or node]. Collections then refer to their ways as [slot,
+#    reversed], and ways to their tagged nodes by slot. Ways that differ only in
+#    the direction of their refs and coords, as when the collector joins a way
+#    into several routes, share a single record. Slots are reused once
+#    MAX_RECORDS other ways or nodes have been written, so readers only need to
+#    hold that many records.
+#
+#    Readers give each collection its own copy of each way, including its
+#    segments, tags, coords and tagged nodes, so that post-processors can
+#    change a way in one collection without changing it in the others, just as
+#    with the default layout. Packed coords stay packed in the copies.
+#
+# Readers accept any mix of layouts, so these options only need to be given to
+# the writer. Older versions of the tools can only read the default layout.
+import hashlib
+import struct
+import sys
+from array import array
+from collections.abc import MutableSequence
+from itertools import accumulate
+import msgpack
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Flags for the boolean values of segments in the columnar layout.
+SEGMENT_FLAGS = {
+    'curvature_filtered': 1,
+}
+
+# MessagePack extension type codes.
+COORDS_EXT_TYPE = 1
+REFS_EXT_TYPE = 2
+
+# The number of fixed-point units in a degree.
+FIXED_POINT_SCALE = 10000000
+
+# The largest number of strings in a string table.
+MAX_STRINGS = 65536
+
+# The number of slots for way and node records in a normalized stream.
+MAX_RECORDS = 65536
+
+# The keys of ways which can be reversed by reversing their refs and coords.
+REVERSIBLE_WAY_KEYS = frozenset(['id', 'tags', 'refs', 'coords', 'nodes'])
+
+# Options for unpacking collections.
+UNPACK_OPTIONS = {'use_list': True, 'raw': False}
+if msgpack.version >= (0, 6, 1):
+    # Tagged nodes are keyed by their integer refs, which newer versions of
+    # msgpack only allow as map keys when asked to.
+    UNPACK_OPTIONS['strict_map_key'] = False
+
+# Read collections from a file, converting them to the default layout.
+#
+# Packed coords are read as PackedCoords, which unpack them when they are first
+# used, unless lazy_coords is False.
+def read_stream(file, lazy_coords=True):
+    return iter(StreamReader(file, lazy_coords))
+
+class StreamReader(object):
+
+    def __init__(self, file, lazy_coords=True):
+        self.ext_hook = decode_ext if lazy_coords else decode_ext_eagerly
+        self.unpacker = msgpack.Unpacker(file, ext_hook=self.ext_hook, **UNPACK_OPTIONS)
+        self.strings = []
+        # The way records (packed, with their tags) and node records of a
+        # normalized stream by slot.
+        self.ways = {}
+        self.nodes = {}
+
+    def __iter__(self):
+        for collection in self.unpacker:
+            yield(self.decode_collection(collection))
+
+    def decode_collection(self, collection):
+        if 'string_table' in collection:
+            first_new_string, new_strings = collection.pop('string_table')
+            # Streams written separately and then joined start their tables over.
+            del self.strings[first_new_string:]
+            self.strings.extend(sys.intern(string) for string in new_strings)
+        for slot, node in collection.pop('node_table', []):
+            self.decode_node(node)
+            self.nodes[slot] = node
+        for slot, way in collection.pop('way_table', []):
+            self.decode_way(way)
+            if way.get('nodes'):
+                way['nodes'] = dict((ref, self.nodes[node_slot]) for ref, node_slot in way['nodes'].items())
+            # Ways are held packed, as unpacking them is the fastest way to
+            # make copies that share nothing. Copies share the decoded tags'
+            # (interned) strings.
+            self.ways[slot] = (packb(way), way.get('tags'))
+        ways = collection['ways']
+        for i, way in enumerate(ways):
+            if type(way) == list:
+                ways[i] = self.copy_way(*way)
+            else:
+                self.decode_way(way)
+                if way.get('nodes'):
+                    for node in way['nodes'].values():
+                        self.decode_node(node)
+        return collection
+
+    def decode_way(self, way):
+        if 'segment_columns' in way:
+            decode_way_columns(way)
+        if type(way.get('tags')) == list:
+            way['tags'] = decode_tags(way['tags'], self.strings)
+
+    def decode_node(self, node):
+        if type(node.get('tags')) == list:
+            node['tags'] = decode_tags(node['tags'], self.strings)
+
+    # Copy a way record for a collection.
+    def copy_way(self, slot, reversed):
+        data, tags = self.ways[slot]
+        way = msgpack.unpackb(data, ext_hook=self.ext_hook, **UNPACK_OPTIONS)
+        if tags is not None:
+            way['tags'] = dict(tags)
+        if reversed:
+            way['refs'] = way['refs'][::-1]
+            way['coords'] = way['coords'][::-1]
+        return way
+
+class StreamWriter(object):
+
+    def __init__(self, file, columnar=False, packed_coords=False, string_table=False, normalized=False):
+        self.file = file
+        self.columnar = columnar
+        self.packed_coords = packed_coords
+        self.string_table = string_table
+        self.strings = []
+        # The index of each string in the table.
+        self.string_indexes = {}
+        self.normalized = normalized
+        self.way_slots = RecordSlots(MAX_RECORDS)
+        self.node_slots = RecordSlots(MAX_RECORDS)
+
+    def write(self, collection):
+        if self.columnar or self.packed_coords or self.string_table or self.normalized:
+            collection = dict(collection)
+            first_new_string = len(self.strings)
+            if self.normalized and self.can_normalize(collection):
+                self.way_slots.start_collection()
+                self.node_slots.start_collection()
+                new_ways = []
+                new_nodes = []
+                collection['ways'] = [self.normalize_way(way, new_ways, new_nodes) for way in collection['ways']]
+                if new_nodes:
+                    collection['node_table'] = new_nodes
+                if new_ways:
+                    collection['way_table'] = new_ways
+            else:
+                collection['ways'] = [self.encode_way(way) for way in collection['ways']]
+            if len(self.strings) > first_new_string:
+                collection['string_table'] = [first_new_string, self.strings[first_new_string:]]
+        self.file.write(msgpack.packb(collection, use_bin_type=True, default=self.encode_default))
+
+    # Write out coords read from packed data in the layout of this writer.
+    def encode_default(self, value):
+        if isinstance(value, PackedCoords):
+            if self.packed_coords:
+                packed = pack_coords(value)
+                if packed is not None:
+                    return packed
+            return value.unpacked()
+        raise TypeError('Can not serialize {}'.format(type(value).__name__))
+
+    def encode_way(self, way):
+        if self.columnar:
+            way = encode_way_columns(way)
+        if self.packed_coords:
+            way = encode_way_coords(way)
+        if self.string_table:
+            way = self.encode_way_tags(way)
+        return way
+
+    # Collections with more ways or tagged nodes than could fit in half of the
+    # slots are written without normalizing them.
+    def can_normalize(self, collection):
+        records = 0
+        for way in collection['ways']:
+            records += 1 + len(way.get('nodes') or ())
+        return records <= MAX_RECORDS // 2
+
+    # Return a reference to a way for a normalized collection, adding a record
+    # of it to new_ways (and of its tagged nodes to new_nodes) if it hasn't been
+    # written recently.
+    def normalize_way(self, way, new_ways, new_nodes):
+        reversed = 0
+        refs = way.get('refs')
+        if refs and refs[-1] < refs[0] and REVERSIBLE_WAY_KEYS.issuperset(way):
+            # Write ways that can be reversed in one direction so that routes
+            # joining them in either direction can share them.
+            way = dict(way)
+            way['refs'] = refs[::-1]
+            way['coords'] = way['coords'][::-1]
+            reversed = 1
+        digest = hashlib.blake2b(packb(way), digest_size=16).digest()
+        slot = self.way_slots.find(digest)
+        if slot is None:
+            slot = self.way_slots.allocate(digest)
+            if way.get('nodes'):
+                way = dict(way)
+                way['nodes'] = dict((ref, self.normalize_node(node, new_nodes)) for ref, node in way['nodes'].items())
+            new_ways.append([slot, self.encode_way(way)])
+        return [slot, reversed]
+
+    # Return the slot of a tagged node, adding a record of it to new_nodes if
+    # it hasn't been written recently.
+    def normalize_node(self, node, new_nodes):
+        digest = hashlib.blake2b(packb(node), digest_size=16).digest()
+        slot = self.node_slots.find(digest)
+        if slot is None:
+            slot = self.node_slots.allocate(digest)
+            if self.string_table:
+                node = self.encode_node_tags(node)
+            new_nodes.append([slot, node])
+        return slot
+
+    # Return a copy of a way with the tags of it and its nodes as indexes into
+    # the string table.
+    def encode_way_tags(self, way):
+        tags = self.encode_tags(way.get('tags'))
+        # The nodes of normalized ways are written separately.
+        nodes = None if self.normalized else way.get('nodes')
+        if tags is None and not nodes:
+            return way
+        way = dict(way)
+        if tags is not None:
+            way['tags'] = tags
+        if nodes:
+            way['nodes'] = dict((ref, self.encode_node_tags(node)) for ref, node in nodes.items())
+        return way
+
+    def encode_node_tags(self, node):
+        tags = self.encode_tags(node.get('tags'))
+        if tags is None:
+            return node
+        node = dict(node)
+        node['tags'] = tags
+        return node
+
+    # Encode a dict of tags as a list of [key, value, key, value...] indexes.
+    # Returns None if the tags aren't all strings.
+    def encode_tags(self, tags):
+        if not isinstance(tags, dict):
+            return None
+        for key, value in tags.items():
+            if type(key) != str or type(value) != str:
+                return None
+        string_indexes = self.string_indexes
+        indexes = []
+        for item in tags.items():
+            for string in item:
+                index = string_indexes.get(string)
+                if index is None:
+                    if len(self.strings) >= MAX_STRINGS:
+                        indexes.append(string)
+                        continue
+                    index = string_indexes[string] = len(self.strings)
+                    self.strings.append(string)
+                indexes.append(index)
+        return indexes
+
+# The slots of the way or node records written to a normalized stream.
+class RecordSlots(object):
+
+    def __init__(self, size):
+        self.size = size
+        # The slot of each record, keyed by a digest of its contents.
+        self.slots = {}
+        # The digest of the record in each slot.
+        self.digests = [None] * size
+        self.next_slot = 0
+        # The slots used by the collection being written. Readers add all of the
+        # new records of a collection before resolving its references, so these
+        # must not be reused until the next collection.
+        self.in_use = set()
+
+    def start_collection(self):
+        self.in_use = set()
+
+    # Return the slot of a record written before, or None.
+    def find(self, digest):
+        slot = self.slots.get(digest)
+        if slot is not None:
+            self.in_use.add(slot)
+        return slot
+
+    # Return a slot for a new record, replacing the oldest record.
+    def allocate(self, digest):
+        while self.next_slot in self.in_use:
+            self.next_slot = (self.next_slot + 1) % self.size
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.size
+        self.slots.pop(self.digests[slot], None)
+        self.slots[digest] = slot
+        self.digests[slot] = digest
+        self.in_use.add(slot)
+        return slot
+
+# Pack a single collection as it is, for example to hold it temporarily on disk.
+# Packed coords stay packed.
+def packb(collection):
+    return msgpack.packb(collection, use_bin_type=True, default=encode_packed_coords)
+
+# Unpack a collection packed with packb().
+def unpackb(data):
+    return msgpack.unpackb(data, ext_hook=decode_ext, **UNPACK_OPTIONS)
+
+def encode_packed_coords(value):
+    if isinstance(value, PackedCoords):
+        return pack_coords(value) or value.unpacked()
+    raise TypeError('Can not serialize {}'.format(type(value).__name__))
+
+def decode_ext(code, data):
+    if code == COORDS_EXT_TYPE:
+        return PackedCoords(data)
+    if code == REFS_EXT_TYPE:
+        return unpack_refs(data)
+    return msgpack.ExtType(code, data)
+
+def decode_ext_eagerly(code, data):
+    if code == COORDS_EXT_TYPE:
+        return unpack_coords(data)
+    return decode_ext(code, data)
+
+def decode_tags(indexes, strings):
+    try:
+        return dict(zip(map(strings.__getitem__, indexes[0::2]), map(strings.__getitem__, indexes[1::2])))
+    except TypeError:
+        # Some strings were written in place of their indexes.
+        items = iter([strings[index] if type(index) == int else index for index in indexes])
+        return dict(zip(items, items))
+
+# Return a copy of a way with its segments in columns.
+#
+# Ways are left in the default layout if their segments can't be represented
+# exactly in columns: if they don't run along the way's coords without gaps (as
+# after filter_segments_by_radius), or don't all have the same values.
+def encode_way_columns(way):
+    segments = way.get('segments')
+    if not segments:
+        return way
+    coords = way['coords']
+    if len(coords) != len(segments) + 1:
+        return way
+    keys = [key for key in segments[0] if key not in ('start', 'end') and key not in SEGMENT_FLAGS]
+    columns = dict((key, []) for key in keys)
+    flags = []
+    for i, segment in enumerate(segments):
+        if segment['start'] != coords[i] or segment['end'] != coords[i + 1]:
+            return way
+        segment_flags = 0
+        for key, value in segment.items():
+            if key in SEGMENT_FLAGS:
+                if value is not True:
+                    return way
+                segment_flags |= SEGMENT_FLAGS[key]
+        if len(segment) - 2 - bin(segment_flags).count('1') != len(keys):
+            return way
+        try:
+            for key in keys:
+                columns[key].append(segment[key])
+        except KeyError:
+            return way
+        flags.append(segment_flags)
+    if any(flags):
+        columns['flags'] = flags
+    way = dict((key, value) for key, value in way.items() if key != 'segments')
+    way['segment_columns'] = columns
+    return way
+
+# Convert the segments of a way from columns back to a list of dicts.
+def decode_way_columns(way):
+    columns = way.pop('segment_columns')
+    coords = way['coords']
+    flags = columns.pop('flags', None)
+    segments = [{'start': coords[i], 'end': coords[i + 1]} for i in range(len(coords) - 1)]
+    for key, values in columns.items():
+        for segment, value in zip(segments, values):
+            segment[key] = value
+    if flags is not None:
+        for segment, segment_flags in zip(segments, flags):
+            if segment_flags:
+                for key, flag in SEGMENT_FLAGS.items():
+                    if segment_flags & flag:
+                        segment[key] = True
+    way['segments'] = segments
+    return way
+
+# Return a copy of a way with its coords and refs packed into extension types.
+def encode_way_coords(way):
+    packed = {}
+    if way.get('coords'):
+        packed['coords'] = pack_coords(way['coords'])
+    if way.get('refs'):
+        packed['refs'] = pack_refs(way['refs'])
+    packed = dict((key, value) for key, value in packed.items() if value is not None)
+    if not packed:
+        return way
+    way = dict(way)
+    way.update(packed)
+    return way
+
+# Pack a list of coords into an extension type.
+#
+# The data is the number of coords and the number of coords with a ref as a
+# third value, the (lat, lon) of each coord as 32-bit fixed-point integers, then
+# the index and ref of each coord with a ref. All values are little-endian.
+#
+# Returns None if the coords can't be packed exactly.
+def pack_coords(coords):
+    if isinstance(coords, PackedCoords) and coords.data is not None:
+        return msgpack.ExtType(COORDS_EXT_TYPE, coords.data)
+    try:
+        refs = [(i, coord[2]) for i, coord in enumerate(coords) if len(coord) != 2]
+        for i, ref in refs:
+            if len(coords[i]) != 3 or type(ref) != int:
+                return None
+        if numpy is not None:
+            points = numpy.array([coord[:2] for coord in coords] if refs else coords, dtype=numpy.float64)
+            if points.shape != (len(coords), 2):
+                return None
+            fixed = numpy.rint(points * FIXED_POINT_SCALE)
+            if not (fixed / FIXED_POINT_SCALE == points).all() or numpy.abs(fixed).max() > 2147483647:
+                return None
+            values = fixed.astype('<i4').tobytes()
+        else:
+            values = array('i')
+            for coord in coords:
+                lat = round(coord[0] * FIXED_POINT_SCALE)
+                lon = round(coord[1] * FIXED_POINT_SCALE)
+                if lat / FIXED_POINT_SCALE != coord[0] or lon / FIXED_POINT_SCALE != coord[1]:
+                    return None
+                values.append(lat)
+                values.append(lon)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            values = values.tobytes()
+        data = [struct.pack('<II', len(coords), len(refs)), values]
+        data.extend(struct.pack('<Iq', i, ref) for i, ref in refs)
+    except (TypeError, ValueError, OverflowError, struct.error):
+        return None
+    return msgpack.ExtType(COORDS_EXT_TYPE, b''.join(data))
+
+def unpack_coords(data):
+    count, ref_count = struct.unpack_from('<II', data)
+    end = 8 + count * 8
+    if numpy is not None:
+        coords = (numpy.frombuffer(data, '<i4', count * 2, 8).reshape(count, 2) / FIXED_POINT_SCALE).tolist()
+    else:
+        values = array('i', data[8:end])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        values = iter(values)
+        coords = [[lat / FIXED_POINT_SCALE, lon / FIXED_POINT_SCALE] for lat, lon in zip(values, values)]
+    for i, ref in struct.iter_unpack('<Iq', data[end:]):
+        coords[i].append(ref)
+    return coords
+
+# The coords of a way read from packed data.
+#
+# The coords are only unpacked when they are first used, so post-processors
+# that don't use the coords of a way don't pay to unpack them. Coords that were
+# never unpacked are written out again from their packed data.
+class PackedCoords(MutableSequence):
+
+    def __init__(self, data):
+        self.data = data
+        self.coords = None
+
+    def unpacked(self):
+        if self.coords is None:
+            self.coords = unpack_coords(self.data)
+            # The coords may be changed once they have been handed out.
+            self.data = None
+        return self.coords
+
+    def __len__(self):
+        if self.coords is None:
+            return struct.unpack_from('<I', self.data)[0]
+        return len(self.coords)
+
+    def __getitem__(self, index):
+        return self.unpacked()[index]
+
+    def __setitem__(self, index, value):
+        self.unpacked()[index] = value
+
+    def __delitem__(self, index):
+        del self.unpacked()[index]
+
+    def insert(self, index, value):
+        self.unpacked().insert(index, value)
+
+    def __iter__(self):
+        return iter(self.unpacked())
+
+    def __eq__(self, other):
+        if isinstance(other, PackedCoords):
+            other = other.unpacked()
+        return self.unpacked() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.unpacked())
+
+# Pack a list of refs into an extension type.
+#
+# The data is the size in bytes of the differences between refs (4 or 8), the
+# first ref, then the difference of each following ref from the one before it.
+# All values are little-endian.
+#
+# Returns None if the refs can't be packed exactly.
+def pack_refs(refs):
+    if any(type(ref) != int for ref in refs):
+        return None
+    differences = [b - a for a, b in zip(refs, refs[1:])]
+    try:
+        values = array('i', differences)
+    except OverflowError:
+        try:
+            values = array('q', differences)
+        except OverflowError:
+            return None
+    if sys.byteorder == 'big':
+        values.byteswap()
+    try:
+        header = struct.pack('<Bq', values.itemsize, refs[0])
+    except struct.error:
+        return None
+    return msgpack.ExtType(REFS_EXT_TYPE, header + values.tobytes())
+
+def unpack_refs(data):
+    itemsize, first = struct.unpack_from('<Bq', data)
+    values = array('i' if itemsize == 4 else 'q', data[9:])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return list(accumulate(values, initial=first))
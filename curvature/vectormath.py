@@ -0,0 +1,74 @@
+# Vectorized versions of the calculations in geomath and radiusmath which work
+# on whole arrays of values at once. These require NumPy.
+#
+# The functions in geomath and radiusmath are the reference implementations.
+# The results here use the same formulas, but NumPy's trigonometric functions
+# may differ from Python's math module in the last bit or so. The spherical law
+# of cosines magnifies such differences for short distances, as does the
+# circumcircle radius for nearly straight lines of points, so results are
+# expected to agree with the reference implementations to within 1mm in
+# lengths and a relative difference of 1e-6 in radii, rather than exactly.
+import numpy
+from curvature.geomath import rad_earth_m
+
+degrees_to_radians = numpy.pi / 180.0
+
+# Vectorized version of geomath.distance_on_earth().
+def distances_on_earth(lat1, long1, lat2, long2):
+    return distances_on_unit_sphere(lat1, long1, lat2, long2) * rad_earth_m
+
+# Vectorized version of geomath.distance_on_unit_sphere().
+def distances_on_unit_sphere(lat1, long1, lat2, long2):
+    phi1 = (90.0 - lat1) * degrees_to_radians
+    phi2 = (90.0 - lat2) * degrees_to_radians
+    theta1 = long1 * degrees_to_radians
+    theta2 = long2 * degrees_to_radians
+    cos = (numpy.sin(phi1) * numpy.sin(phi2) * numpy.cos(theta1 - theta2) +
+           numpy.cos(phi1) * numpy.cos(phi2))
+    arc = numpy.arccos(numpy.minimum(cos, 1.0))
+    # Identical points are always a distance of 0.
+    arc[(lat1 == lat2) & (long1 == long2)] = 0
+    return arc
+
+# Vectorized version of radiusmath.circum_circle_radius().
+def circum_circle_radii(a, b, c, max_radius=10000):
+    divider = numpy.sqrt(numpy.fabs((a+b+c)*(b+c-a)*(c+a-b)*(a+b-c)))
+    valid = (a > 0) & (b > 0) & (c > 0) & (divider != 0)
+    radii = numpy.full(len(a), float(max_radius))
+    radii[valid] = (a[valid] * b[valid] * c[valid]) / divider[valid]
+    return radii
+
+# Calculate the lengths of segments and the radii of the curves they are part of,
+# the same as the add_segment_length_and_radius post-processor.
+#
+# Returns arrays of the length and radius of each segment.
+def segment_lengths_and_radii(start_lat, start_lon, end_lat, end_lon, max_radius=10000):
+    lengths = distances_on_earth(start_lat, start_lon, end_lat, end_lon)
+    radii = numpy.empty(len(lengths))
+    if len(lengths) == 1:
+        radii[0] = max_radius
+    elif len(lengths) > 1:
+        # The triangles formed by each segment and the one after it.
+        base_lengths = distances_on_earth(start_lat[:-1], start_lon[:-1], end_lat[1:], end_lon[1:])
+        triangle_radii = circum_circle_radii(lengths[:-1], lengths[1:], base_lengths, max_radius)
+        # The first and last segments are only part of one triangle, the
+        # others take the smaller radius of their two triangles.
+        radii[0] = triangle_radii[0]
+        radii[1:-1] = numpy.minimum(triangle_radii[:-1], triangle_radii[1:])
+        radii[-1] = min(triangle_radii[-1], max_radius)
+    return lengths, radii
+
+# Classify segments into curvature levels based on their radii and weight
+# their lengths to give their curvature.
+#
+# max_radii and weights are ordered from level 1 (broad curves) to level 4
+# (sharp curves). Segments with radii not below any of the max_radii are level
+# 0 and have no curvature.
+#
+# Returns arrays of the curvature level and curvature of each segment.
+def classify_curvature(lengths, radii, max_radii, weights):
+    # Check the sharpest curves first.
+    conditions = [radii < max_radius for max_radius in reversed(max_radii)]
+    levels = numpy.select(conditions, range(len(max_radii), 0, -1), 0)
+    curvatures = lengths * numpy.select(conditions, list(reversed(weights)), 0)
+    return levels, curvatures
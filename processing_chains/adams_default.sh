@@ -100,35 +100,26 @@ do
     # 8. Filter out collections not meeting our minimum curvature thresholds.
     # 9. Sort the items by their curvature value.
     # 10. Save the intermediate data.
-    $script_path/curvature-collect --highway_types 'motorway,trunk,primary,secondary,tertiary,unclassified,residential,service,motorway_link,trunk_link,primary_link,secondary_link,service' $verbose $input_file \
-      | $script_path/curvature-pp filter_out_ways_with_tag --tag surface --values 'unpaved,compacted,dirt,gravel,fine_gravel,sand,grass,ground,pebblestone,mud,clay,dirt/sand,soil' \
-      | $script_path/curvature-pp filter_out_ways_with_tag --tag service --values 'driveway,parking_aisle,drive-through,parking,bus,emergency_access,alley' \
-      | $script_path/curvature-pp filter_out_ways_with_tag --tag area --values 'yes' \
-      | $script_path/curvature-pp filter_out_ways_with_tag --tag golf --values 'cartpath' \
-      | $script_path/curvature-pp filter_out_ways_with_tag --tag access --values 'no' \
-      | $script_path/curvature-pp filter_out_ways_with_tag --tag vehicle --values 'no' \
-      | $script_path/curvature-pp filter_out_ways_with_tag --tag motor_vehicle --values 'no' \
-      | $script_path/curvature-pp filter_out_ways --match 'And(TagEmpty("name"), TagEmpty("ref"), TagEquals("highway", "residential"), TagEquals("tiger:reviewed", "no"))' \
-      | $script_path/curvature-pp filter_out_ways --match 'And(TagEquals("highway", "raceway"), TagEquals("sport", "motocross"))' \
-      | $script_path/curvature-pp filter_out_ways --match 'And(TagEquals("highway", "service"), Or(TagEquals("access", "private"), TagEquals("motor_vehicle", "private"), TagEquals("vehicle", "private")))' \
-      | $script_path/curvature-pp add_segments \
-      | $script_path/curvature-pp add_segment_length_and_radius \
-      | $script_path/curvature-pp add_segment_curvature \
-      | $script_path/curvature-pp filter_segment_deflections \
-      | $script_path/curvature-pp squash_curvature_for_tagged_ways --tag junction --values 'roundabout,circular' \
-      | $script_path/curvature-pp squash_curvature_for_tagged_ways --tag traffic_calming \
-      | $script_path/curvature-pp squash_curvature_for_ways --match 'TagAndValueRegex("^parking:lane:(both|left|right)", "parallel|diagonal|perpendicular|marked")' \
-      | $script_path/curvature-pp squash_curvature_for_ways --match 'TagAndValueRegex("^parking:lane:(both|left|right):(parallel|diagonal|perpendicular)", "^(on_street|on_kerb|half_on_kerb|painted_area_only)$")' \
-      | $script_path/curvature-pp squash_curvature_near_way_tag_change --tag junction --only-values 'roundabout,circular' --distance 30 \
-      | $script_path/curvature-pp squash_curvature_near_way_tag_change --tag oneway --ignored-values 'no' --distance 30 \
-      | $script_path/curvature-pp squash_curvature_near_tagged_nodes --tag highway --values 'stop,give_way,traffic_signals,crossing,mini_roundabout,traffic_calming' --distance 30 \
-      | $script_path/curvature-pp squash_curvature_near_tagged_nodes --tag traffic_calming --distance 30 \
-      | $script_path/curvature-pp squash_curvature_near_tagged_nodes --tag barrier --distance 30 \
-      | $script_path/curvature-pp split_collections_on_straight_segments --length 2414 \
-      | $script_path/curvature-pp roll_up_length \
-      | $script_path/curvature-pp roll_up_curvature \
-      | $script_path/curvature-pp filter_collections_by_curvature --min 300 \
-      | $script_path/curvature-pp sort_collections_by_sum --key curvature --direction DESC \
+    $script_path/curvature-collect --highway_types 'motorway,trunk,primary,secondary,tertiary,unclassified,residential,service,motorway_link,trunk_link,primary_link,secondary_link,service' --referenced-nodes-only --node-tags 'highway,traffic_calming,barrier' $verbose $input_file \
+      | $script_path/curvature-pp filter_out_ways_with_tags \
+          --rule 'surface=unpaved,compacted,dirt,gravel,fine_gravel,sand,grass,ground,pebblestone,mud,clay,dirt/sand,soil' \
+          --rule 'service=driveway,parking_aisle,drive-through,parking,bus,emergency_access,alley' \
+          --rule 'area=yes' \
+          --rule 'golf=cartpath' \
+          --rule 'access=no' \
+          --rule 'vehicle=no' \
+          --rule 'motor_vehicle=no' \
+        -- filter_out_ways --match 'And(TagEmpty("name"), TagEmpty("ref"), TagEquals("highway", "residential"), TagEquals("tiger:reviewed", "no"))' \
+        -- filter_out_ways --match 'And(TagEquals("highway", "raceway"), TagEquals("sport", "motocross"))' \
+        -- filter_out_ways --match 'And(TagEquals("highway", "service"), Or(TagEquals("access", "private"), TagEquals("motor_vehicle", "private"), TagEquals("vehicle", "private")))' \
+        -- add_segments_and_curvature \
+        -- filter_segment_deflections \
+        -- apply_curvature_rules --rules $my_path/adams_default.rules \
+        -- split_collections_on_straight_segments --length 2414 \
+        -- roll_up_length \
+        -- roll_up_curvature \
+        -- filter_collections_by_curvature --min 300 \
+        -- sort_collections_by_sum --key curvature --direction DESC \
       > $temp_dir/$filename.msgpack
   else
     if [[ $verbose == '-v' ]]
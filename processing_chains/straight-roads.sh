@@ -94,7 +94,7 @@ do
     # 3. Exclude US TIGER-imported ways that don't have names or ref tags and have not been
     #    reviewed. These are most likely driveways or forest tracks.
     # 4. Add segments and their lengths & radii.
-    $script_path/curvature-collect --highway_types 'motorway,trunk,primary,secondary,tertiary,unclassified,residential,service,motorway_link,trunk_link,primary_link,secondary_link,service' $verbose $input_file \
+    $script_path/curvature-collect --highway_types 'motorway,trunk,primary,secondary,tertiary,unclassified,residential,service,motorway_link,trunk_link,primary_link,secondary_link,service' --referenced-nodes-only --node-tags 'highway,traffic_calming,barrier' $verbose $input_file \
       | $script_path/curvature-pp filter_out_ways_with_tag --tag surface --values 'unpaved,compacted,dirt,gravel,fine_gravel,sand,grass,ground,pebblestone,mud,clay,dirt/sand,soil' \
       | $script_path/curvature-pp filter_out_ways_with_tag --tag area --values 'yes' \
       | $script_path/curvature-pp filter_out_ways_with_tag --tag golf --values 'cartpath' \
@@ -134,14 +134,7 @@ do
   cat $temp_dir/$filename.msgpack \
     | $script_path/curvature-pp add_segment_curvature --l1maxr 2000 \
     | $script_path/curvature-pp filter_segment_deflections \
-    | $script_path/curvature-pp inflate_curvature_for_tagged_ways --curvature=999 --tag traffic_calming \
-    | $script_path/curvature-pp inflate_curvature_for_ways --curvature=999 --match 'TagAndValueRegex("^parking:lane:(both|left|right)", "parallel|diagonal|perpendicular|marked")' \
-    | $script_path/curvature-pp inflate_curvature_for_ways --curvature=999 --match 'TagAndValueRegex("^parking:lane:(both|left|right):(parallel|diagonal|perpendicular)", "^(on_street|on_kerb|half_on_kerb|painted_area_only)$")' \
-    | $script_path/curvature-pp inflate_curvature_near_way_tag_change --curvature=999 --tag junction --only-values 'roundabout,circular' --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_way_tag_change --curvature=999 --tag oneway --ignored-values 'no' --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_tagged_nodes --curvature=999 --tag highway --values 'stop,give_way,traffic_signals,crossing,mini_roundabout,traffic_calming' --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_tagged_nodes --curvature=999 --tag traffic_calming --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_tagged_nodes --curvature=999 --tag barrier --distance 30 \
+    | $script_path/curvature-pp apply_curvature_rules --rules $my_path/straight-roads.rules \
     | $script_path/curvature-pp split_collections_on_straight_segments --length 300 \
     | $script_path/curvature-pp roll_up_length \
     | $script_path/curvature-pp roll_up_curvature \
@@ -179,14 +172,7 @@ do
   cat $temp_dir/$filename.msgpack \
     | $script_path/curvature-pp add_segment_curvature --l1maxr 4000 \
     | $script_path/curvature-pp filter_segment_deflections \
-    | $script_path/curvature-pp inflate_curvature_for_tagged_ways --curvature=999 --tag traffic_calming \
-    | $script_path/curvature-pp inflate_curvature_for_ways --curvature=999 --match 'TagAndValueRegex("^parking:lane:(both|left|right)", "parallel|diagonal|perpendicular|marked")' \
-    | $script_path/curvature-pp inflate_curvature_for_ways --curvature=999 --match 'TagAndValueRegex("^parking:lane:(both|left|right):(parallel|diagonal|perpendicular)", "^(on_street|on_kerb|half_on_kerb|painted_area_only)$")' \
-    | $script_path/curvature-pp inflate_curvature_near_way_tag_change --curvature=999 --tag junction --only-values 'roundabout,circular' --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_way_tag_change --curvature=999 --tag oneway --ignored-values 'no' --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_tagged_nodes --curvature=999 --tag highway --values 'stop,give_way,traffic_signals,crossing,mini_roundabout,traffic_calming' --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_tagged_nodes --curvature=999 --tag traffic_calming --distance 30 \
-    | $script_path/curvature-pp inflate_curvature_near_tagged_nodes --curvature=999 --tag barrier --distance 30 \
+    | $script_path/curvature-pp apply_curvature_rules --rules $my_path/straight-roads.rules \
     | $script_path/curvature-pp split_collections_on_straight_segments --length 300 \
     | $script_path/curvature-pp roll_up_length \
     | $script_path/curvature-pp roll_up_curvature \
@@ -4,7 +4,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 import pytest
 from curvature.post_processors.add_segment_curvature import AddSegmentCurvature
-from copy import copy
+from copy import copy, deepcopy
 
 def test_straight():
     data = [{'ways': [{'segments': [{
@@ -54,3 +54,24 @@ def test_level_4():
     result = list(AddSegmentCurvature().process(data))
     # Level 1 should have a weighting of '2'
     assert result[0]['ways'][0]['segments'][0]['curvature'] == 20
+
+@pytest.mark.parametrize('arguments', [
+    {},
+    {'l1maxr': 500, 'l2maxr': 200, 'l3maxr': 80, 'l4maxr': 10, 'l1weight': 0.5, 'l2weight': 3, 'l3weight': 4, 'l4weight': 7},
+])
+def test_vectorized_matches_scalar(arguments):
+    pytest.importorskip('numpy')
+    radii = [0, 5, 10, 20, 29.99, 30, 45, 60, 80, 99, 100, 150, 175, 175.01, 200, 500, 10000, 145159487741]
+    data = {'ways': [
+        {'segments': [{'length': 10 + i * 3.7, 'radius': radius} for i, radius in enumerate(radii)]},
+        {'segments': [{'length': 1.5, 'radius': 25}]},
+    ]}
+    scalar = list(AddSegmentCurvature(vectorized=False, **arguments).process([deepcopy(data)]))
+    vectorized = list(AddSegmentCurvature(vectorized=True, **arguments).process([deepcopy(data)]))
+    assert vectorized == scalar
+
+def test_vectorized_requires_length_and_radius():
+    pytest.importorskip('numpy')
+    data = [{'ways': [{'segments': [{'length': 10}]}]}]
+    with pytest.raises(ValueError):
+        list(AddSegmentCurvature(vectorized=True).process(data))
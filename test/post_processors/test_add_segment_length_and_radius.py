@@ -3,7 +3,7 @@ import sys, os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 import pytest
 from curvature.post_processors.add_segment_length_and_radius import AddSegmentLengthAndRadius
-from copy import copy
+from copy import copy, deepcopy
 
 @pytest.fixture
 def south_union_street(south_union_street_a, south_union_street_b):
@@ -392,3 +392,39 @@ def test_add_segments_to_both(south_union_street):
     assert(9 <= segments_b[7]['length'] <= 10)
     # Only one real radius option for the last segment.
     assert(8312 <= segments_b[7]['radius'] <= 8313)
+
+def assert_segments_match(scalar_segments, vectorized_segments):
+    assert len(scalar_segments) == len(vectorized_segments)
+    for scalar, vectorized in zip(scalar_segments, vectorized_segments):
+        assert vectorized['length'] == pytest.approx(scalar['length'], abs=0.001)
+        assert vectorized['radius'] == pytest.approx(scalar['radius'], rel=1e-6)
+
+@pytest.mark.parametrize('fixture', ['basic_straight_road', 'basic_curved_road', 'south_union_street_a', 'south_union_street'])
+def test_vectorized_matches_scalar(request, fixture):
+    pytest.importorskip('numpy')
+    data = request.getfixturevalue(fixture)
+    if 'ways' not in data:
+        data = {'ways': [data]}
+    scalar = list(AddSegmentLengthAndRadius(vectorized=False).process([deepcopy(data)]))[0]
+    vectorized = list(AddSegmentLengthAndRadius(vectorized=True).process([deepcopy(data)]))[0]
+    for scalar_way, vectorized_way in zip(scalar['ways'], vectorized['ways']):
+        assert_segments_match(scalar_way['segments'], vectorized_way['segments'])
+
+def test_vectorized_single_and_repeated_points():
+    pytest.importorskip('numpy')
+    data = {'ways': [
+        {'segments': [{'start': [44.0, -72.0], 'end': [44.001, -72.0]}]},
+        {'segments': [
+            {'start': [44.0, -72.0], 'end': [44.0, -72.0]},
+            {'start': [44.0, -72.0], 'end': [44.001, -72.0, 1234]},
+            {'start': [44.001, -72.0, 1234], 'end': [44.001, -72.0, 1234]},
+            {'start': [44.001, -72.0, 1234], 'end': [44.002, -72.001]}]},
+    ]}
+    for way in data['ways']:
+        collection = {'ways': [way]}
+        scalar = list(AddSegmentLengthAndRadius(vectorized=False).process([deepcopy(collection)]))[0]
+        vectorized = list(AddSegmentLengthAndRadius(vectorized=True).process([deepcopy(collection)]))[0]
+        assert_segments_match(scalar['ways'][0]['segments'], vectorized['ways'][0]['segments'])
+
+def test_parse_scalar():
+    assert AddSegmentLengthAndRadius.parse(['--scalar']).vectorized == False
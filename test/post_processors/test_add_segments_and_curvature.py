@@ -0,0 +1,54 @@
+# Add our parent folder to our path
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import pytest
+from curvature.post_processors.add_segments_and_curvature import AddSegmentsAndCurvature
+from curvature.post_processors.add_segments import AddSegments
+from curvature.post_processors.add_segment_length_and_radius import AddSegmentLengthAndRadius
+from curvature.post_processors.add_segment_curvature import AddSegmentCurvature
+from copy import deepcopy
+
+@pytest.fixture
+def collections():
+    return [
+        {'join_type': 'name',
+         'join_data': 'Curvy Road',
+         'ways': [
+            {'id': 1, 'coords': [[44.0, -72.0], [44.001, -72.0], [44.0015, -72.0005], [44.0015, -72.0015, 123]]},
+            {'id': 2, 'coords': [[44.0015, -72.0015, 123], [44.001, -72.002], [44.001, -72.002], [44.0, -72.0021], [43.999, -72.003]]},
+         ]},
+        {'join_type': 'none',
+         'ways': [
+            {'id': 3, 'coords': [[44.1, -72.1], [44.11, -72.1]]},
+         ]},
+        {'join_type': 'none',
+         'ways': [
+            {'id': 4, 'coords': [[44.2, -72.2]]},
+         ]},
+    ]
+
+def separate_stages(collections, vectorized, **arguments):
+    result = AddSegments().process(collections)
+    result = AddSegmentLengthAndRadius(vectorized).process(result)
+    result = AddSegmentCurvature(vectorized=vectorized, **arguments).process(result)
+    return list(result)
+
+@pytest.mark.parametrize('vectorized', [False, True])
+def test_same_as_separate_stages(collections, vectorized):
+    if vectorized:
+        pytest.importorskip('numpy')
+    expected = separate_stages(deepcopy(collections), vectorized)
+    result = list(AddSegmentsAndCurvature(vectorized=vectorized).process(deepcopy(collections)))
+    assert result == expected
+    # The segments should contain the same keys in the same order.
+    for result_collection, expected_collection in zip(result, expected):
+        for result_way, expected_way in zip(result_collection['ways'], expected_collection['ways']):
+            for result_segment, expected_segment in zip(result_way['segments'], expected_way['segments']):
+                assert list(result_segment.keys()) == list(expected_segment.keys())
+    assert result[0]['ways'][0]['segments'][1]['curvature_level'] > 0
+
+def test_parse():
+    processor = AddSegmentsAndCurvature.parse(['--l1maxr', '200', '--l4weight', '3', '--scalar'])
+    assert processor.curvature.level_1_max_radius == 200
+    assert processor.curvature.level_4_weight == 3
+    assert processor.vectorized == False
@@ -0,0 +1,84 @@
+# Add our parent folder to our path
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+import pytest
+import random
+from curvature.post_processors.apply_curvature_rules import ApplyCurvatureRules
+from curvature.pipeline import chain_post_processors
+from copy import deepcopy
+
+squash_rules = [
+    "squash_curvature_for_tagged_ways --tag junction --values 'roundabout,circular'",
+    "squash_curvature_for_tagged_ways --tag traffic_calming",
+    "squash_curvature_for_ways --match 'TagAndValueRegex(\"^parking:lane:(both|left|right)\", \"parallel|diagonal\")'",
+    "squash_curvature_near_way_tag_change --tag junction --only-values 'roundabout,circular' --distance 30",
+    "squash_curvature_near_way_tag_change --tag oneway --ignored-values 'no' --distance 30",
+    "squash_curvature_near_tagged_nodes --tag highway --values 'stop,give_way,traffic_signals' --distance 30",
+    "squash_curvature_near_tagged_nodes --tag barrier --distance 30",
+]
+
+inflate_rules = [
+    "inflate_curvature_for_tagged_ways --curvature=999 --tag traffic_calming",
+    "inflate_curvature_for_ways --curvature=999 --match 'TagAndValueRegex(\"^parking:lane:(both|left|right)\", \"parallel|diagonal\")'",
+    "inflate_curvature_near_way_tag_change --curvature=999 --tag oneway --ignored-values 'no' --distance 30",
+    "inflate_curvature_near_tagged_nodes --curvature=999 --tag highway --values 'stop,give_way,traffic_signals' --distance 30",
+    "inflate_curvature_near_tagged_nodes --curvature=5 --tag barrier --distance 50",
+]
+
+def roads(seed):
+    rand = random.Random(seed)
+    collections = []
+    ref = 1
+    for c in range(5):
+        ways = []
+        for w in range(rand.randint(1, 5)):
+            tags = {'highway': 'primary'}
+            for tag, values in (('junction', ['roundabout', 'circular', 'yes']), ('traffic_calming', ['bump']), ('parking:lane:both', ['parallel', 'no']), ('oneway', ['yes', 'no'])):
+                if rand.random() < 0.3:
+                    tags[tag] = rand.choice(values)
+            way = {'id': len(ways) + 1, 'tags': tags, 'nodes': {}, 'segments': []}
+            if rand.random() < 0.5:
+                way['curvature'] = rand.randint(0, 100)
+            for s in range(rand.randint(1, 8)):
+                start = [0.0, 0.0]
+                end = [0.0, 0.0]
+                for point in (start, end):
+                    if rand.random() < 0.15:
+                        ref += 1
+                        point.append(ref)
+                        way['nodes'][ref] = {'tags': rand.choice([{'highway': 'stop'}, {'highway': 'crossing'}, {'barrier': 'gate'}])}
+                segment = {'start': start, 'end': end, 'length': rand.uniform(1, 40)}
+                if rand.random() < 0.9:
+                    segment['curvature_level'] = rand.randint(0, 4)
+                    segment['curvature'] = segment['curvature_level'] * segment['length']
+                way['segments'].append(segment)
+            ways.append(way)
+        collections.append({'join_type': 'none', 'ways': ways})
+    return collections
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('rules', [squash_rules, inflate_rules, inflate_rules[:2] + squash_rules + inflate_rules[2:]])
+def test_same_as_separate_post_processors(seed, rules):
+    data = roads(seed)
+    argv = []
+    for rule in rules:
+        argv.extend(['--rule', rule])
+    result = list(ApplyCurvatureRules.parse(argv).process(deepcopy(data)))
+
+    separate = [ApplyCurvatureRules.load_rule(rule) for rule in rules]
+    expected = list(chain_post_processors(deepcopy(data), separate))
+    assert result == expected
+    assert result != data
+
+def test_rules_file(tmp_path):
+    rules_file = tmp_path / 'rules'
+    rules_file.write_text('# Squash near roundabouts\n' + squash_rules[0] + '\n\n' + squash_rules[6] + '\n')
+    processor = ApplyCurvatureRules.parse(['--rules', str(rules_file), '--rule', inflate_rules[0]])
+    assert len(processor.rules) == 3
+    assert processor.rules[1].tag == 'barrier'
+    assert processor.rules[1].distance == 30
+
+def test_unsupported_rule():
+    with pytest.raises(ValueError):
+        ApplyCurvatureRules.parse(['--rule', 'head -n 1'])
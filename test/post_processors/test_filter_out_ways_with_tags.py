@@ -0,0 +1,84 @@
+# Add our parent folder to our path
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import random
+import pytest
+from copy import deepcopy
+from curvature.pipeline import chain_post_processors
+from curvature.post_processors.filter_out_ways_with_tag import FilterOutWaysWithTag
+from curvature.post_processors.filter_out_ways_with_tags import FilterOutWaysWithTags
+
+@pytest.fixture
+def old_mountain_road():
+    return {
+        'join_type': 'name',
+        'join_data': 'Old Mountain Road',
+        'ways': [
+            { 'id': 200000,
+              'tags': {   'highway': 'unclassified',
+                          'name': 'Old Mountain Road',
+                          'surface': 'asphalt'},
+              'coords': [],
+              'refs': []
+            },
+            { 'id': 200001,
+              'tags': {   'highway': 'unclassified',
+                          'name': 'Old Mountain Road',
+                          'surface': 'gravel'},
+              'coords': [],
+              'refs': []
+            },
+            { 'id': 200002,
+              'tags': {   'highway': 'unclassified',
+                          'name': 'Old Mountain Road'},
+              'coords': [],
+              'refs': []
+            },
+            { 'id': 200003,
+              'tags': {   'highway': 'unclassified',
+                          'name': 'Old Mountain Road',
+                          'access': 'no'},
+              'coords': [],
+              'refs': []
+            },
+            { 'id': 200004,
+              'tags': {   'highway': 'unclassified',
+                          'name': 'Old Mountain Road',
+                          'surface': 'asphalt'},
+              'coords': [],
+              'refs': []
+            }]}
+
+def test_filter_out_ways_with_tags(old_mountain_road):
+    data = [old_mountain_road]
+    result = list(FilterOutWaysWithTags([('surface', ['gravel', 'dirt']), ('access', ['no'])]).process(data))
+    assert len(result) == 3
+    assert [way['id'] for way in result[0]['ways']] == [200000]
+    assert [way['id'] for way in result[1]['ways']] == [200002]
+    assert [way['id'] for way in result[2]['ways']] == [200004]
+    assert result[1]['join_data'] == 'Old Mountain Road'
+
+def test_parse():
+    processor = FilterOutWaysWithTags.parse(['--rule', 'surface=gravel,dirt', '--rule', 'access=no', '--rule', 'surface=sand'])
+    assert processor.values_by_tag == {'surface': {'gravel', 'dirt', 'sand'}, 'access': {'no'}}
+
+@pytest.mark.parametrize('rule', ['surface', 'surface=', '=gravel'])
+def test_parse_invalid_rule(rule):
+    with pytest.raises(SystemExit):
+        FilterOutWaysWithTags.parse(['--rule', rule])
+
+def test_same_as_sequential_stages():
+    rng = random.Random(1)
+    tags = ['surface', 'service', 'area', 'access']
+    values = ['gravel', 'dirt', 'yes', 'no', 'driveway', 'asphalt']
+    rules = [(tag, rng.sample(values, rng.randint(1, 3))) for tag in tags]
+    collections = []
+    for i in range(200):
+        collections.append({
+            'join_type': 'name',
+            'join_data': 'Road {}'.format(i),
+            'ways': [{'id': j, 'tags': {tag: rng.choice(values) for tag in rng.sample(tags, rng.randint(0, 3))}} for j in range(rng.randint(1, 8))]})
+
+    sequential = list(chain_post_processors(deepcopy(collections), [FilterOutWaysWithTag(tag, values) for tag, values in rules]))
+    combined = list(FilterOutWaysWithTags(rules).process(deepcopy(collections)))
+    assert combined == sequential
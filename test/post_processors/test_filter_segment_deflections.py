@@ -5,7 +5,7 @@ import pytest
 from curvature.post_processors.filter_segment_deflections import FilterSegmentDeflections
 from curvature.post_processors.add_segment_length_and_radius import AddSegmentLengthAndRadius
 from curvature.post_processors.add_segment_curvature import AddSegmentCurvature
-from copy import copy
+from copy import copy, deepcopy
 
 @pytest.fixture
 def way_deviated_a():
@@ -151,3 +151,18 @@ def test_filter_b_a(way_deviated_b, way_deviated_a):
     for i, segment in enumerate(result[0]['ways'][1]['segments']):
         assert segment['curvature'] == 0, 'curvature should be 0 for segment a {}'.format(i)
         assert segment['curvature_level'] == 0, 'curvature_level should be 0 for segment a {}'.format(i)
+
+def test_precalculated_headings(way_deviated_b, way_deviated_a):
+    # Filtering with precalculated headings should give the same result as
+    # calculating the headings for each comparison.
+    filter = FilterSegmentDeflections()
+    filter.keep_eliminated = True
+    expected = deepcopy(way_deviated_b['segments'] + way_deviated_a['segments'])
+    for i in range(len(expected)):
+        for look_ahead in range(3, 8):
+            filter.filter_deflection_of_straight_segments(expected, i, look_ahead)
+
+    segments = deepcopy(way_deviated_b['segments'] + way_deviated_a['segments'])
+    filter.filter_deflections(segments)
+    assert segments == expected
+    assert any('curvature_filtered' in segment for segment in segments)
@@ -1,6 +1,7 @@
 # Add our parent folder to our path
 import sys, os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import random
 import pytest
 from curvature.post_processors.sort_collections_by_sum import SortCollectionsBySum
 
@@ -43,3 +44,49 @@ def test_sort_collections_by_sum_asc(roads):
     assert result[1]['ways'][0]['id'] == 4
     assert result[2]['ways'][0]['id'] == 1
     assert result[2]['ways'][1]['id'] == 2
+
+def random_roads(count):
+    rng = random.Random(7)
+    roads = []
+    for i in range(count):
+        roads.append({
+            'join_type': 'name',
+            'join_data': 'Road {}'.format(i),
+            'ways': [{'id': i * 10 + j, 'segments': [{'length': rng.randint(0, 20)} for k in range(rng.randint(1, 3))]} for j in range(rng.randint(1, 3))]})
+    return roads
+
+@pytest.mark.parametrize('reverse', [True, False])
+def test_sort_collections_by_sum_in_runs(tmp_path, reverse):
+    roads = random_roads(500)
+    expected = list(SortCollectionsBySum(key='length', reverse=reverse).process(roads))
+    result = list(SortCollectionsBySum(key='length', reverse=reverse, buffer_size=2000, temp_dir=str(tmp_path)).process(roads))
+    assert result == expected
+    # Temporary files are removed once the stream has been read.
+    assert list(tmp_path.iterdir()) == []
+
+# Tagged nodes are keyed by their integer refs.
+def test_sort_collections_by_sum_in_runs_with_nodes(tmp_path):
+    roads = random_roads(100)
+    for road in roads:
+        for way in road['ways']:
+            way['nodes'] = {way['id'] * 100 + 1: {'highway': 'stop'}, way['id'] * 100 + 2: {'barrier': 'gate'}}
+    expected = list(SortCollectionsBySum(key='length').process(roads))
+    result = list(SortCollectionsBySum(key='length', buffer_size=500, temp_dir=str(tmp_path)).process(roads))
+    assert result == expected
+
+def test_sort_collections_by_sum_in_buffer(roads):
+    result = list(SortCollectionsBySum(key='length', reverse=True, buffer_size=1024 * 1024).process(roads))
+    assert [way['id'] for collection in result for way in collection['ways']] == [1, 2, 4, 3]
+
+@pytest.mark.parametrize('reverse', [True, False])
+@pytest.mark.parametrize('limit', [0, 1, 10, 1000])
+def test_sort_collections_by_sum_limit(reverse, limit):
+    roads = random_roads(500)
+    expected = list(SortCollectionsBySum(key='length', reverse=reverse).process(roads))[:limit]
+    result = list(SortCollectionsBySum(key='length', reverse=reverse, limit=limit).process(roads))
+    assert result == expected
+
+def test_parse_limit():
+    processor = SortCollectionsBySum.parse(['--key', 'curvature', '--limit', '10'])
+    assert processor.limit == 10
+    assert processor.reverse
@@ -3,7 +3,8 @@ import sys, os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 import pytest
 from copy import copy
-from curvature.collection_tools import CollectionSegmentTraverser
+from curvature.collection_tools import CollectionSegmentTraverser, CollectionSegmentIndex, find_segments_nearby
+import random
 
 
 def my_collection():
@@ -292,3 +293,48 @@ def test_traversal_forward_reset_backward_with_next():
     assert segment['curvature'] == 1
 
     assert traverser.has_next() == False
+
+@pytest.mark.parametrize('distance', [0, 10, 30, 60, 1000])
+def test_segment_index_nearby(distance):
+    collection = my_collection()
+    index = CollectionSegmentIndex(collection)
+    for i, way in enumerate(collection['ways']):
+        for j in range(len(way['segments'])):
+            for end in ('start', 'end'):
+                expected = find_segments_nearby(collection, i, j, end, distance)
+                result = index.find_segments_nearby(i, j, end, distance)
+                assert [id(segment) for segment in result] == [id(segment) for segment in expected]
+
+@pytest.mark.parametrize('seed', range(20))
+def test_segment_index_nearby_random(seed):
+    rand = random.Random(seed)
+    collection = {'ways': []}
+    for w in range(rand.randint(1, 6)):
+        # Ways without segments can't be traversed past.
+        num_segments = rand.choice([0, 1, 2, 5, 10])
+        collection['ways'].append({'segments': [{'length': rand.choice([0, rand.uniform(0, 40)])} for s in range(num_segments)]})
+    index = CollectionSegmentIndex(collection)
+    for i, way in enumerate(collection['ways']):
+        for j in range(len(way['segments'])):
+            for end in ('start', 'end'):
+                for distance in (0, 5, 30, 100):
+                    expected = find_segments_nearby(collection, i, j, end, distance)
+                    result = index.find_segments_nearby(i, j, end, distance)
+                    assert [id(segment) for segment in result] == [id(segment) for segment in expected]
+
+def test_segment_index_missing_segment():
+    index = CollectionSegmentIndex({'ways': [{'segments': [{'length': 5}]}, {'segments': []}]})
+    with pytest.raises(IndexError):
+        index.find_segments_nearby(1, 0, 'start', 30)
+
+def test_segment_index_count_nearby():
+    collection = my_collection()
+    index = CollectionSegmentIndex(collection)
+    initial_segments = [(0, 1, 'start'), (1, 0, 'end'), (1, 0, 'end')]
+    expected = {}
+    for way_index, segment_index, segment_end in initial_segments:
+        for segment in find_segments_nearby(collection, way_index, segment_index, segment_end, 30):
+            expected[id(segment)] = expected.get(id(segment), 0) + 1
+    result = index.count_segments_nearby(iter(initial_segments), 30)
+    assert dict((id(segment), count) for segment, count in result) == expected
+    assert index.count_segments_nearby(iter([]), 30) == []
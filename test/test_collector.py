@@ -3,7 +3,7 @@ import sys, os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 import pytest
 from copy import copy
-from curvature.collector import WayCollector
+from curvature.collector import WayCollector, pack_location, unpack_location
 
 
 from collections import namedtuple
@@ -807,3 +807,291 @@ def test_joining_stays_on_higher_class_roads(forlandet):
     assert len(collections[1]['ways']) == 1
     assert collections[1]['ways'][0]['id'] == 20003
     assert collections[1]['ways'][0]['tags']['highway'] == 'service'
+
+# Test that a long route split into many ways (provided in arbitrary order) is
+# joined back into a single collection in the correct sequence.
+def test_join_route_with_many_ways():
+    collector = WayCollector()
+    ways = []
+    for i in range(500):
+        ways.append({
+            'id': 50000 + i,
+            'tags': {'highway': 'primary', 'ref': 'US 2'},
+            'refs': [i * 10, i * 10 + 5, (i + 1) * 10],
+            'coords': [(i, 0), (i + 0.5, 0), (i + 1, 0)],
+            'nodes': {}})
+    # Reverse every third way and shuffle the order that they are provided in.
+    for way in ways[1::3]:
+        way['refs'] = list(reversed(way['refs']))
+        way['coords'] = list(reversed(way['coords']))
+    shuffled = ways[250:] + ways[:250]
+    shuffled.reverse()
+
+    collections = collector.join_route({'join_type': 'ref', 'join_data': 'US 2', 'ways': shuffled})
+    assert len(collections) == 1
+    assert [way['id'] for way in collections[0]['ways']] == [way['id'] for way in ways]
+    for i, way in enumerate(collections[0]['ways']):
+        assert way['refs'] == [i * 10, i * 10 + 5, (i + 1) * 10]
+        assert way['coords'] == [(i, 0), (i + 0.5, 0), (i + 1, 0)]
+
+# Test that joining routes in multiple processes gives the same results as
+# joining them in a single process.
+def test_collector_parallel_join(vermont_125_and_us_7, us2):
+    for file in (vermont_125_and_us_7, us2):
+        serial = []
+        collector = WayCollector()
+        collector.parse(file, callback=lambda collection: serial.append(collection))
+
+        parallel = []
+        collector = WayCollector()
+        collector.jobs = 2
+        collector.parse(file, callback=lambda collection: parallel.append(collection))
+
+        assert parallel == serial
+
+def test_collector_chooses_sparse_node_index_for_small_files(vermont_125):
+    collector = WayCollector()
+    assert collector.choose_node_index(vermont_125) == 'sparse_mem_array'
+    collector.node_index_file = '/tmp/node-index'
+    assert collector.choose_node_index(vermont_125) == 'sparse_file_array'
+    collector.node_index = 'dense_mem_array'
+    assert collector.choose_node_index(vermont_125) == 'dense_mem_array'
+
+# Test that file-backed node indexes give the same results as an in-memory
+# index, both when first built and when reused.
+@pytest.mark.parametrize('node_index', ['sparse_file_array', 'dense_file_array'])
+def test_collector_file_node_index(vermont_125, tmp_path, node_index):
+    expected = []
+    collector = WayCollector()
+    collector.parse(vermont_125, callback=lambda collection: expected.append(collection))
+
+    index_file = str(tmp_path / node_index)
+    for i in range(2):
+        collections = []
+        collector = WayCollector()
+        collector.node_index = node_index
+        collector.node_index_file = index_file
+        collector.parse(vermont_125, callback=lambda collection: collections.append(collection))
+        assert collections == expected
+        assert os.path.exists(index_file + '.source')
+
+def test_collector_file_node_index_requires_file(vermont_125):
+    collector = WayCollector()
+    collector.node_index = 'dense_file_array'
+    with pytest.raises(ValueError):
+        collector.parse(vermont_125, callback=lambda collection: None)
+
+# Test that only highway ways of the types requested are collected.
+def test_collector_filters_ways(road_xml_dir, vermont_125_and_us_7_node_data, vermont_125_and_us_7_way_data):
+    way_data = vermont_125_and_us_7_way_data + (
+        (
+            40001,
+            {   'name':     'Town Hall',
+                'building': 'yes'},
+            [209, 210, 211, 209]
+        ),
+    )
+    file = writeOSMFile(str(road_xml_dir / 'filtered_ways'), vermont_125_and_us_7_node_data, way_data)
+
+    collections = []
+    collector = WayCollector()
+    collector.parse(file, callback=lambda collection: collections.append(collection))
+    way_ids = set(way['id'] for collection in collections for way in collection['ways'])
+    assert way_ids == set([20000, 20001, 20002, 20003, 20004, 30001, 30002])
+
+    collections = []
+    collector = WayCollector()
+    collector.roads = ['primary']
+    collector.parse(file, callback=lambda collection: collections.append(collection))
+    way_ids = set(way['id'] for collection in collections for way in collection['ways'])
+    assert way_ids == set([20001, 30001, 30002])
+
+# Test that tagged nodes can be limited to those referenced by our ways and
+# to those with certain tags.
+def test_collector_filters_tagged_nodes(road_xml_dir, vermont_125_node_data, vermont_125_way_data):
+    node_data = vermont_125_node_data + (
+        (400, (43.70400, -73.00400), {'natural': 'tree'}),
+        (401, (43.70401, -73.00401), {'barrier': 'gate'}),
+    )
+    way_data = vermont_125_way_data + (
+        (
+            40001,
+            {   'name':     'Town Hall',
+                'building': 'yes'},
+            [401, 209, 210, 401]
+        ),
+    )
+    file = writeOSMFile(str(road_xml_dir / 'filtered_nodes'), node_data, way_data)
+
+    collector = WayCollector()
+    collector.tagged_nodes = {}
+    collector.load_file(file)
+    assert set(collector.tagged_nodes.keys()) == set([217, 400, 401])
+
+    collector = WayCollector()
+    collector.tagged_nodes = {}
+    collector.referenced_nodes_only = True
+    collector.load_file(file)
+    assert set(collector.tagged_nodes.keys()) == set([217])
+
+    collector = WayCollector()
+    collector.tagged_nodes = {}
+    collector.node_tags = ['barrier', 'traffic_calming']
+    collector.load_file(file)
+    assert set(collector.tagged_nodes.keys()) == set([401])
+
+# Test that filtering out ways while collecting gives the same results as
+# filtering them out afterward with the filter_out_ways post-processor.
+@pytest.mark.parametrize('match_expression', [
+    'TagEquals("name", "Court Street")',
+    'Or(TagEquals("ref", "US 7"), TagEquals("highway", "secondary"))',
+    'Id(28483253, 158420752)',
+    'TagEquals("junction", "roundabout")',
+])
+def test_collector_filter_out_ways(vermont_125_and_us_7, us2, match_expression):
+    from curvature.post_processors.filter_out_ways import FilterOutWays
+    for file in (vermont_125_and_us_7, us2):
+        collections = []
+        collector = WayCollector()
+        collector.parse(file, callback=lambda collection: collections.append(collection))
+        expected = list(FilterOutWays(match_expression).process(collections))
+
+        collections = []
+        collector = WayCollector()
+        collector.add_way_filter(match_expression)
+        collector.parse(file, callback=lambda collection: collections.append(collection))
+        assert collections == expected
+
+# Test that sending collections to the callback as they are completed gives
+# the same results, in the same order, as sending them all at the end.
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_collector_emit_incrementally(tmp_path, vermont_125_node_data, vermont_125_way_data, vermont_125_and_us_7, us2, road_a, jobs):
+    # Add some ways without a name or ref, which will not be joined.
+    way_data = vermont_125_way_data + (
+        (40001, {'highway': 'service'}, [216, 217, 218]),
+        (40002, {'highway': 'service'}, [220, 219]),
+    )
+    unjoined = writeOSMFile(str(tmp_path / 'unjoined'), vermont_125_node_data, way_data)
+    for file in (unjoined, vermont_125_and_us_7, us2, road_a):
+        expected = []
+        collector = WayCollector()
+        collector.add_way_filter('TagEquals("name", "Court Street")')
+        collector.parse(file, callback=lambda collection: expected.append(collection))
+
+        collections = []
+        collector = WayCollector()
+        collector.add_way_filter('TagEquals("name", "Court Street")')
+        collector.emit_incrementally = True
+        collector.jobs = jobs
+        collector.parse(file, callback=lambda collection: collections.append(collection))
+        assert collections == expected
+
+# Test that our workers and routes are released if sending along a collection
+# fails, as when the output is closed early.
+def test_collector_parallel_join_callback_fails(vermont_125_and_us_7):
+    import curvature.collector
+    def callback(collection):
+        raise BrokenPipeError()
+    collector = WayCollector()
+    collector.jobs = 2
+    collector.emit_incrementally = True
+    with pytest.raises(BrokenPipeError):
+        collector.parse(vermont_125_and_us_7, callback=callback)
+    assert curvature.collector.forked_collector is None
+    assert curvature.collector.forked_routes is None
+
+@pytest.mark.parametrize('lat,lon', [
+    (44.2679, -72.6094),
+    (-33.8688, 151.2093),
+    (-90.0, -180.0),
+    (90.0, 180.0),
+    (0.0, 0.0),
+])
+def test_pack_location(lat, lon):
+    packed = pack_location(round(lat * 10000000), round(lon * 10000000))
+    assert unpack_location(packed) == (lat, lon)
+
+def test_collector_exports_lists(vermont_125_and_us_7):
+    collections = []
+    collector = WayCollector()
+    collector.parse(vermont_125_and_us_7, callback=lambda collection: collections.append(collection))
+    for collection in collections:
+        for way in collection['ways']:
+            assert type(way['refs']) is list
+            assert type(way['coords']) is list
+            assert len(way['refs']) == len(way['coords'])
+
+# Test that nodes without a valid location are dropped along with their refs
+# so that refs and coords stay aligned.
+def test_collector_skips_invalid_locations(tmp_path, road_a_node_data, road_a_way_data):
+    # Node 99 isn't in the file, so it has no location.
+    way_data = road_a_way_data + (
+        (10010, {'name': 'Road B', 'highway': 'unclassified'}, [9, 99, 10, 11]),
+    )
+    file = writeOSMFile(str(tmp_path / 'invalid_locations'), road_a_node_data, way_data)
+    collections = []
+    collector = WayCollector()
+    collector.parse(file, callback=lambda collection: collections.append(collection))
+    ways = [way for collection in collections for way in collection['ways'] if way['id'] == 10010]
+    assert len(ways) == 1
+    assert ways[0]['refs'] == [9, 10, 11]
+    assert len(ways[0]['coords']) == 3
+
+def collection_ids(collections):
+    return sorted([way['id'] for way in collection['ways']] for collection in collections)
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_collector_spills_routes(tmp_path, vermont_125_and_us_7, us2, road_a, incremental):
+    for file in (vermont_125_and_us_7, us2, road_a):
+        expected = []
+        collector = WayCollector()
+        collector.parse(file, callback=lambda collection: expected.append(collection))
+
+        collections = []
+        collector = WayCollector()
+        collector.max_memory = 1
+        collector.spill_dir = str(tmp_path)
+        collector.emit_incrementally = incremental
+        collector.parse(file, callback=lambda collection: collections.append(collection))
+        assert collection_ids(collections) == collection_ids(expected)
+        for collection in expected:
+            assert collection in collections
+        # Our spill files are cleaned up.
+        assert os.listdir(str(tmp_path)) == []
+
+# A collector that records the most routes it has held in memory at once.
+class JoinCountingCollector(WayCollector):
+    most_routes = 0
+
+    def join_ways(self, callback=None):
+        self.most_routes = max(self.most_routes, len(self.routes))
+        WayCollector.join_ways(self, callback)
+
+# Test that partitions larger than max_memory are split before they are joined
+# and that unjoined collections are spilled along with our routes.
+def test_collector_splits_spilled_partitions(tmp_path, vermont_125_node_data, vermont_125_way_data, vermont_125_and_us_7, us2):
+    way_data = vermont_125_way_data + (
+        (40001, {'highway': 'service'}, [216, 217, 218]),
+        (40002, {'highway': 'service'}, [220, 219]),
+    )
+    unjoined = writeOSMFile(str(tmp_path / 'unjoined'), vermont_125_node_data, way_data)
+    spill_dir = tmp_path / 'spill'
+    spill_dir.mkdir()
+    for file in (unjoined, vermont_125_and_us_7, us2):
+        expected = []
+        collector = WayCollector()
+        collector.parse(file, callback=lambda collection: expected.append(collection))
+
+        collections = []
+        collector = JoinCountingCollector()
+        collector.max_memory = 1
+        collector.spill_partitions = 1
+        collector.spill_dir = str(spill_dir)
+        collector.parse(file, callback=lambda collection: collections.append(collection))
+        assert collection_ids(collections) == collection_ids(expected)
+        for collection in expected:
+            assert collection in collections
+        # Each route is joined on its own.
+        assert collector.most_routes == 1
+        assert collector.collections == []
+        assert os.listdir(str(spill_dir)) == []
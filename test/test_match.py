@@ -2,12 +2,20 @@
 import sys, os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
+import random
+import re
 import pytest
 from curvature.match import And
 from curvature.match import Or
 from curvature.match import Not
 from curvature.match import TagEmpty
 from curvature.match import TagEquals
+from curvature.match import TagContains
+from curvature.match import TagRegex
+from curvature.match import TagAndValueRegex
+from curvature.match import Id
+from curvature.match import parse_match_expression
+from curvature.match import compile_match
 
 @pytest.fixture
 def way_residential_no():
@@ -144,3 +152,102 @@ def test_not(collection_2, way_unclassified, way_residential):
     assert not_residential.match(way_unclassified)
     assert not not_residential.match(way_residential)
     assert not_residential.match(collection_2)
+
+def test_parse_match_expression(way_residential_no, way_residential):
+    match = parse_match_expression('And(TagEmpty("name"), TagEquals("highway", "residential"), TagEquals("tiger:reviewed", "no"))')
+    assert isinstance(match, And)
+    assert [type(term) for term in match.terms] == [TagEmpty, TagEquals, TagEquals]
+    assert match.match(way_residential_no)
+    assert not match.match(way_residential)
+
+    match = parse_match_expression('Or(TagRegex("^HIGHWAY$", re.IGNORECASE), Id(-1, 2))')
+    assert match.terms[0].regex.flags & re.IGNORECASE
+    assert match.terms[1].ids == (-1, 2)
+
+@pytest.mark.parametrize('match_expression', [
+    '__import__("os").system("true")',
+    'TagEquals("highway", open("/etc/passwd").read())',
+    'And(TagEquals("highway", "residential"), lambda way: True)',
+    'TagEquals("highway", "residential").match',
+    'Id(*[1, 2])',
+    'TagEquals("highway"',
+    'TagEquals("highway", "")',
+])
+def test_parse_match_expression_rejects_invalid(match_expression):
+    with pytest.raises(ValueError):
+        parse_match_expression(match_expression)
+
+def test_compile_match(collection_1, collection_2, collection_3, collection_4, way_residential_no, way_residential_yes, way_residential, way_unclassified):
+    match = compile_match('And(TagEquals("highway", "residential"), Or(TagEmpty("tiger:reviewed"), TagEquals("tiger:reviewed", "yes")))')
+    assert not match.match(way_residential_no)
+    assert match.match(way_residential_yes)
+    assert match.match(way_residential)
+    assert not match.match(way_unclassified)
+    assert match.match(collection_1)
+    assert not match.match(collection_2)
+    assert not match.match(collection_3)
+    assert match.match(collection_4)
+
+def random_term(rng, depth=0):
+    tags = ['highway', 'name', 'ref', 'tiger:reviewed', 'access', 'surface']
+    values = ['residential', 'service', 'no', 'yes', 'private', 'dirt', '']
+    kinds = ['TagEmpty', 'TagEquals', 'TagContains', 'TagRegex', 'TagAndValueRegex', 'Id']
+    if depth < 3:
+        kinds = kinds + ['And', 'Or', 'Not'] * 2
+    kind = rng.choice(kinds)
+    if kind in ('And', 'Or'):
+        return [And, Or][kind == 'Or'](*[random_term(rng, depth + 1) for i in range(rng.randint(1, 4))])
+    if kind == 'Not':
+        return Not(random_term(rng, depth + 1))
+    if kind == 'TagEmpty':
+        return TagEmpty(rng.choice(tags))
+    if kind == 'TagEquals':
+        return TagEquals(rng.choice(tags), rng.choice(values[:-1]))
+    if kind == 'TagContains':
+        return TagContains(rng.choice(tags), rng.choice(['es', 'o', 'private']))
+    if kind == 'TagRegex':
+        return TagRegex(rng.choice(['^high', 'tiger:', 'name|ref', '(a)c', '(?i)SURFACE', r'(.)\1']))
+    if kind == 'TagAndValueRegex':
+        return TagAndValueRegex(rng.choice(['^highway$', 'a', '^(name|ref)$']), rng.choice(['^res', '^(yes|no)$', 'd']))
+    return Id(*rng.sample(range(5), rng.randint(1, 3)))
+
+def random_way(rng, id):
+    tags = ['highway', 'name', 'ref', 'tiger:reviewed', 'access', 'surface', 'aa']
+    values = ['residential', 'service', 'no', 'yes', 'private', 'dirt', '']
+    return {'id': id, 'tags': {tag: rng.choice(values) for tag in rng.sample(tags, rng.randint(0, len(tags)))}}
+
+def test_compile_match_is_equivalent():
+    rng = random.Random(42)
+    for i in range(500):
+        expression = random_term(rng)
+        compiled = compile_match(expression)
+        ways = [random_way(rng, id) for id in range(5)]
+        for way in ways:
+            assert compiled.match(way) == expression.match(way)
+            assert compiled.match_way(way) == expression.match_way(way)
+        for j in range(3):
+            collection = {'join_type': 'arbitrary', 'ways': rng.sample(ways, rng.randint(1, 3))}
+            assert compiled.match(collection) == expression.match(collection)
+
+# Regexes with groups aren't combined, as group references would refer to the
+# groups of the other regexes.
+def test_compile_match_keeps_regex_groups():
+    expression = Or(TagRegex('(a)x'), TagRegex('(b)?(?(1)c|d)'), TagRegex('y'))
+    compiled = compile_match(expression)
+    for key in ['bd', 'bc', 'd', 'ax', 'y', 'z']:
+        way = {'id': 1, 'tags': {key: 'yes'}}
+        assert compiled.match_way(way) == expression.match_way(way)
+
+# Compiled matches can be pickled, for instance to send post-processors that
+# use them to worker processes.
+def test_pickle_compiled_match(collection_1, collection_2, way_residential_no, way_residential):
+    import pickle
+    from curvature.post_processors.filter_out_ways import FilterOutWays
+    match = compile_match('Or(And(TagEquals("highway", "residential"), TagEmpty("tiger:reviewed")), TagRegex("^name", re.IGNORECASE))')
+    unpickled = pickle.loads(pickle.dumps(match))
+    for way_or_collection in (collection_1, collection_2, way_residential_no, way_residential):
+        assert unpickled.match(way_or_collection) == match.match(way_or_collection)
+
+    post_processor = FilterOutWays('TagEquals("highway", "residential")')
+    unpickled = pickle.loads(pickle.dumps(post_processor))
+    assert list(unpickled.process([collection_1, collection_2])) == list(post_processor.process([collection_1, collection_2]))
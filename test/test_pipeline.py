@@ -0,0 +1,66 @@
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import pytest
+from curvature.pipeline import split_stages, load_post_processors, chain_post_processors, group_stages, run_post_processors
+from curvature.post_processors.head import Head
+from curvature.post_processors.filter_collections_by_curvature import FilterCollectionsByCurvature
+
+@pytest.fixture
+def data():
+    return [
+        {'join_type': 'none', 'ways': [{'id': 1, 'curvature': 2}]},
+        {'join_type': 'none', 'ways': [{'id': 2, 'curvature': 6}]},
+        {'join_type': 'none', 'ways': [{'id': 3, 'curvature': 7}]},
+    ]
+
+def test_split_stages():
+    assert split_stages(['head', '-n', '10']) == [['head', '-n', '10']]
+    assert split_stages(['add_segments', '--', 'head', '-n', '10']) == [['add_segments'], ['head', '-n', '10']]
+
+def test_split_stages_requires_names():
+    with pytest.raises(ValueError):
+        split_stages(['add_segments', '--'])
+    with pytest.raises(ValueError):
+        split_stages([])
+
+def test_load_post_processors():
+    post_processors = load_post_processors(['filter_collections_by_curvature', '--min', '5', '--', 'head', '-n', '1'])
+    assert len(post_processors) == 2
+    assert isinstance(post_processors[0], FilterCollectionsByCurvature)
+    assert isinstance(post_processors[1], Head)
+    assert post_processors[1].num == 1
+
+def test_chain_post_processors(data):
+    post_processors = load_post_processors(['filter_collections_by_curvature', '--min', '5', '--', 'head', '-n', '1'])
+    result = list(chain_post_processors(iter(data), post_processors))
+    assert result == [data[1]]
+
+def test_group_stages():
+    post_processors = load_post_processors(['add_segments', '--', 'roll_up_length', '--', 'sort_collections_by_sum', '--key', 'length', '--', 'head', '-n', '1', '--', 'roll_up_curvature'])
+    stages = group_stages(post_processors)
+    assert [(per_collection, len(processors)) for per_collection, processors in stages] == [(True, 2), (False, 2), (True, 1)]
+
+@pytest.mark.parametrize('batch_size,max_in_flight', [(1, 1), (2, 3), (100, None)])
+def test_run_post_processors_in_parallel(batch_size, max_in_flight):
+    def make_data():
+        return [
+            {'join_type': 'none', 'ways': [
+                {'id': i, 'coords': [(44.0 + j * 0.001, -72.0 + (i % 3) * j * 0.0005) for j in range(i % 7 + 2)]}]}
+            for i in range(50)]
+    argv = ['add_segments', '--', 'add_segment_length_and_radius', '--', 'add_segment_curvature', '--',
+        'roll_up_length', '--', 'roll_up_curvature', '--', 'filter_collections_by_length', '--min', '100', '--',
+        'sort_collections_by_sum', '--key', 'length', '--', 'head', '-n', '20', '--', 'remove_way_properties', '--properties', 'segments']
+    expected = list(chain_post_processors(make_data(), load_post_processors(argv)))
+    result = list(run_post_processors(iter(make_data()), load_post_processors(argv), jobs=2, batch_size=batch_size, max_in_flight=max_in_flight))
+    assert len(result) == 20
+    assert result == expected
+
+# Without fork, post-processors are run in this process rather than in workers
+# that would re-import the program running them.
+def test_run_post_processors_without_fork(data, monkeypatch):
+    import multiprocessing
+    monkeypatch.setattr(multiprocessing, 'get_all_start_methods', lambda: ['spawn'])
+    monkeypatch.setattr(multiprocessing, 'get_context', None)
+    post_processors = load_post_processors(['filter_collections_by_curvature', '--min', '5', '--', 'head', '-n', '1'])
+    result = list(run_post_processors(iter(data), post_processors, jobs=2))
+    assert result == [data[1]]
@@ -0,0 +1,306 @@
+# Add our parent folder to our path
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import io
+import pytest
+import msgpack
+from copy import deepcopy
+from curvature.pipeline import chain_post_processors
+from curvature.post_processors.add_segments_and_curvature import AddSegmentsAndCurvature
+from curvature.post_processors.filter_segment_deflections import FilterSegmentDeflections
+from curvature.post_processors.filter_segments_by_radius import FilterSegmentsByRadius
+from curvature import stream
+from curvature.stream import read_stream, StreamWriter, PackedCoords, pack_coords, unpack_coords, pack_refs, unpack_refs
+
+@pytest.fixture
+def collections():
+    return [
+        {'join_type': 'name',
+         'join_data': 'Curvy Road',
+         'ways': [
+            {'id': 1, 'tags': {'name': 'Curvy Road'}, 'refs': [1, 2, 3, 4], 'coords': [[44.0, -72.0], [44.001, -72.0], [44.0015, -72.0005], [44.0015, -72.0015]]},
+            {'id': 2, 'tags': {'name': 'Curvy Road'}, 'refs': [4, 5, 6, 7, 8], 'coords': [[44.0015, -72.0015], [44.001, -72.002], [44.0011, -72.0021], [44.0, -72.0021], [43.999, -72.003]]},
+         ]},
+        {'join_type': 'none',
+         'ways': [
+            {'id': 3, 'tags': {}, 'refs': [9], 'coords': [[44.2, -72.2]]},
+         ]},
+    ]
+
+def write_and_read(collections, **options):
+    file = io.BytesIO()
+    writer = StreamWriter(file, **options)
+    for collection in collections:
+        writer.write(collection)
+    file.seek(0)
+    return file.getvalue(), list(read_stream(file))
+
+@pytest.mark.parametrize('post_processors', [
+    [],
+    [AddSegmentsAndCurvature()],
+    [AddSegmentsAndCurvature(), FilterSegmentDeflections()],
+    [AddSegmentsAndCurvature(), FilterSegmentsByRadius(min=100)],
+])
+def test_columnar_read_back(collections, post_processors):
+    collections = list(chain_post_processors(collections, post_processors))
+    default_data, default_result = write_and_read(deepcopy(collections))
+    columnar_data, columnar_result = write_and_read(deepcopy(collections), columnar=True)
+    assert columnar_result == default_result
+    assert len(columnar_data) <= len(default_data)
+
+def test_columnar_layout(collections):
+    collections = list(chain_post_processors(collections, [AddSegmentsAndCurvature(), FilterSegmentDeflections()]))
+    filtered = [segment for segment in collections[0]['ways'][0]['segments'] if 'curvature_filtered' in segment]
+    data, result = write_and_read(deepcopy(collections), columnar=True)
+    raw = list(msgpack.Unpacker(io.BytesIO(data), raw=False))
+    way = raw[0]['ways'][0]
+    assert 'segments' not in way
+    assert set(way['segment_columns']) >= {'length', 'radius', 'curvature', 'curvature_level'}
+    assert len(way['segment_columns']['length']) == 3
+    assert ('flags' in way['segment_columns']) == bool(filtered)
+    # Ways without segments are left as they are.
+    assert raw[1]['ways'][0]['segments'] == []
+    assert result == collections
+
+def test_read_default_layout(collections):
+    file = io.BytesIO(b''.join(msgpack.packb(collection, use_bin_type=True) for collection in collections))
+    assert list(read_stream(file)) == collections
+
+# Tagged nodes are keyed by their integer refs, as in the output of the collector.
+@pytest.mark.parametrize('columnar', [False, True])
+def test_read_integer_keys(collections, columnar):
+    collections = list(chain_post_processors(collections, [AddSegmentsAndCurvature()]))
+    collections[0]['ways'][0]['nodes'] = {2: {'tags': {'highway': 'stop'}, 'lat': 44.001, 'lon': -72.0}}
+    file = io.BytesIO(b''.join(msgpack.packb(collection, use_bin_type=True) for collection in collections))
+    assert list(read_stream(file)) == collections
+    data, result = write_and_read(deepcopy(collections), columnar=columnar)
+    assert result == collections
+
+@pytest.fixture
+def collected():
+    # Collections as output by the collector, with the refs of tagged nodes in their coords.
+    return [
+        {'join_type': 'ref',
+         'join_data': 'VT 100',
+         'ways': [
+            {'id': 1, 'tags': {'ref': 'VT 100'}, 'refs': [8000000001, 8000000002, 12, 8000000005],
+             'coords': [(44.1234567, -72.7654321), (44.1234568, -72.7654322, 8000000002), (-44.0, 172.5), (89.9999999, -179.9999999)]},
+            {'id': 2, 'tags': {'ref': 'VT 100'}, 'refs': [8000000005, 8000000006],
+             'coords': [(89.9999999, -179.9999999), (89.5, -179.5)]},
+         ]},
+    ]
+
+@pytest.fixture(params=[True, False], ids=['numpy', 'no-numpy'])
+def use_numpy(request, monkeypatch):
+    if request.param:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(stream, 'numpy', None)
+
+def test_packed_coords_read_back(collected, use_numpy):
+    default_data, default_result = write_and_read(deepcopy(collected))
+    packed_data, packed_result = write_and_read(deepcopy(collected), packed_coords=True)
+    assert packed_result == default_result
+    assert len(packed_data) < len(default_data)
+    raw = list(msgpack.Unpacker(io.BytesIO(packed_data), raw=False))
+    for way in raw[0]['ways']:
+        assert way['coords'].code == stream.COORDS_EXT_TYPE
+        assert way['refs'].code == stream.REFS_EXT_TYPE
+
+@pytest.mark.parametrize('coords', [
+    [(44.12345678, -72.0)],
+    [(44.0, -72.0, 'a')],
+    [(44.0, -72.0, 1, 2)],
+    [(44.0, 'a')],
+    [(400.0, -72.0)],
+])
+def test_pack_coords_inexact(coords, use_numpy):
+    assert pack_coords(coords) is None
+
+@pytest.mark.parametrize('refs', [
+    [5],
+    [8000000001, 8000000002, 12, 8000000005],
+    [1, 2 ** 40, -3],
+])
+def test_pack_refs(refs):
+    assert unpack_refs(pack_refs(refs).data) == refs
+
+def test_pack_refs_inexact():
+    assert pack_refs([1, 2 ** 70]) is None
+    assert pack_refs([1, 2.5]) is None
+
+def test_packed_coords_unpacked_when_used(collected):
+    data, result = write_and_read(deepcopy(collected), packed_coords=True)
+    coords = result[0]['ways'][0]['coords']
+    assert isinstance(coords, PackedCoords)
+    assert len(coords) == 4
+    packed = coords.data
+    assert packed is not None
+    # Unused coords are written out again from their packed data.
+    assert pack_coords(coords).data == packed
+    # Once used, the coords may be changed so are packed again.
+    assert coords[1] == [44.1234568, -72.7654322, 8000000002]
+    coords[0] = [45.0, -73.0]
+    assert coords.data is None
+    assert unpack_coords(pack_coords(coords).data) == [[45.0, -73.0], [44.1234568, -72.7654322, 8000000002], [-44.0, 172.5], [89.9999999, -179.9999999]]
+
+def test_packed_coords_written_to_default_layout(collected):
+    data, result = write_and_read(deepcopy(collected), packed_coords=True)
+    file = io.BytesIO()
+    StreamWriter(file).write(result[0])
+    raw = msgpack.unpackb(file.getvalue(), raw=False)
+    assert raw['ways'][0]['coords'][1] == [44.1234568, -72.7654322, 8000000002]
+    assert raw['ways'][0]['refs'] == [8000000001, 8000000002, 12, 8000000005]
+
+def test_packed_coords_with_columns(collections):
+    collections = list(chain_post_processors(collections, [AddSegmentsAndCurvature(), FilterSegmentDeflections()]))
+    default_data, default_result = write_and_read(deepcopy(collections))
+    packed_data, packed_result = write_and_read(deepcopy(collections), columnar=True, packed_coords=True)
+    assert packed_result == default_result
+
+def test_read_tagged_nodes(collected):
+    collected[0]['ways'][0]['nodes'] = {8000000002: {'tags': {'highway': 'stop'}, 'lat': 44.1234568, 'lon': -72.7654322}}
+    data, result = write_and_read(deepcopy(collected))
+    assert result[0]['ways'][0]['nodes'] == collected[0]['ways'][0]['nodes']
+
+def test_sort_packed_coords(collected, tmp_path):
+    from curvature.post_processors.sort_collections_by_sum import SortCollectionsBySum
+    collected[0]['ways'][0]['nodes'] = {8000000002: {'tags': {'highway': 'stop'}, 'lat': 44.1234568, 'lon': -72.7654322}}
+    collected[0]['length'] = 5
+    data, collections = write_and_read(collected * 3, packed_coords=True)
+    result = list(SortCollectionsBySum(key='length', buffer_size=1, temp_dir=str(tmp_path)).process(collections))
+    # Packed coords stay packed while sorting.
+    assert result[0]['ways'][0]['coords'].data is not None
+    assert result == collections
+
+def test_string_table(collected):
+    collected[0]['ways'][0]['nodes'] = {8000000002: {'tags': {'highway': 'stop', 'ref': 'VT 100'}, 'lat': 44.1234568, 'lon': -72.7654322}}
+    collected[0]['ways'][1]['tags']['layer'] = 1
+    collections = collected + [{'join_type': 'none', 'ways': [{'id': 3, 'tags': {'ref': 'VT 100', 'name': 'Main Street'}, 'refs': [], 'coords': []}]}]
+    default_data, default_result = write_and_read(deepcopy(collections))
+    data, result = write_and_read(deepcopy(collections), string_table=True)
+    assert result == default_result
+    # Tags are decoded to the same string objects.
+    assert result[0]['ways'][0]['tags']['ref'] is result[1]['ways'][0]['tags']['ref']
+    assert result[0]['ways'][0]['nodes'][8000000002]['tags']['ref'] is result[1]['ways'][0]['tags']['ref']
+
+    raw = list(msgpack.Unpacker(io.BytesIO(data), raw=False, strict_map_key=False))
+    assert raw[0]['string_table'] == [0, ['ref', 'VT 100', 'highway', 'stop']]
+    assert raw[0]['ways'][0]['tags'] == [0, 1]
+    # Tags that aren't all strings are left as they are.
+    assert raw[0]['ways'][1]['tags'] == {'ref': 'VT 100', 'layer': 1}
+    # Only new strings are sent.
+    assert raw[1]['string_table'] == [4, ['name', 'Main Street']]
+    assert raw[1]['ways'][0]['tags'] == [0, 1, 4, 5]
+
+def test_string_table_full(collected, monkeypatch):
+    monkeypatch.setattr(stream, 'MAX_STRINGS', 1)
+    default_data, default_result = write_and_read(deepcopy(collected))
+    data, result = write_and_read(deepcopy(collected), string_table=True)
+    assert result == default_result
+    raw = list(msgpack.Unpacker(io.BytesIO(data), raw=False))
+    assert raw[0]['string_table'] == [0, ['ref']]
+    assert raw[0]['ways'][0]['tags'] == [0, 'VT 100']
+
+def test_string_table_joined_streams(collected):
+    first, result = write_and_read(deepcopy(collected), string_table=True)
+    second, result = write_and_read([{'join_type': 'none', 'ways': [{'id': 3, 'tags': {'name': 'Main Street'}, 'refs': [], 'coords': []}]}], string_table=True)
+    result = list(read_stream(io.BytesIO(first + second)))
+    assert result[1]['ways'][0]['tags'] == {'name': 'Main Street'}
+
+@pytest.fixture
+def routes():
+    # A way joined into two routes in different directions, as by the collector.
+    stop = {'tags': {'highway': 'stop'}, 'lat': 44.1234568, 'lon': -72.7654322}
+    shared = {'id': 1, 'tags': {'ref': 'US 2;VT 100'}, 'refs': [8000000001, 8000000002, 8000000003],
+              'coords': [(44.1234567, -72.7654321), (44.1234568, -72.7654322, 8000000002), (44.0, -72.5)],
+              'nodes': {8000000002: stop}}
+    reversed_shared = dict(shared)
+    reversed_shared['refs'] = shared['refs'][::-1]
+    reversed_shared['coords'] = shared['coords'][::-1]
+    other = {'id': 2, 'tags': {'ref': 'VT 100'}, 'refs': [8000000003, 8000000004],
+             'coords': [(44.0, -72.5), (43.9, -72.4)], 'nodes': {}}
+    return [
+        {'join_type': 'ref', 'join_data': 'US 2', 'ways': [dict(shared)]},
+        {'join_type': 'ref', 'join_data': 'VT 100', 'ways': [other, reversed_shared]},
+        {'join_type': 'none', 'ways': [dict(shared)]},
+    ]
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'packed_coords': True, 'string_table': True},
+])
+def test_normalized(routes, options):
+    default_data, default_result = write_and_read(deepcopy(routes))
+    data, result = write_and_read(deepcopy(routes), normalized=True, **options)
+    assert result == default_result
+    assert len(data) < len(default_data)
+
+    raw = list(msgpack.Unpacker(io.BytesIO(data), raw=False, strict_map_key=False))
+    assert [slot for slot, node in raw[0]['node_table']] == [0]
+    assert raw[0]['way_table'][0][1]['nodes'] == {8000000002: 0}
+    assert raw[0]['ways'] == [[0, 0]]
+    assert 'node_table' not in raw[1]
+    assert raw[1]['ways'] == [[1, 0], [0, 1]]
+    assert 'way_table' not in raw[2]
+    assert raw[2]['ways'] == [[0, 0]]
+
+def test_normalized_copy_on_write(routes):
+    data, result = write_and_read(deepcopy(routes), normalized=True)
+    first = result[0]['ways'][0]
+    last = result[2]['ways'][0]
+    assert first is not last
+    first['curvature'] = 100
+    first['tags']['name'] = 'Main Street'
+    first['nodes'][8000000002]['tags']['stop'] = 'all'
+    assert 'curvature' not in last
+    assert last['tags'] == routes[2]['ways'][0]['tags']
+    assert result[1]['ways'][1]['nodes'] == routes[1]['ways'][1]['nodes']
+
+# Post-processors that change the segments of a way in one collection don't
+# change the same way in the others.
+@pytest.mark.parametrize('options', [
+    {},
+    {'columnar': True, 'packed_coords': True, 'string_table': True},
+])
+def test_normalized_post_processors(routes, options):
+    from curvature.post_processors.add_segments import AddSegments
+    from curvature.post_processors.add_segment_length_and_radius import AddSegmentLengthAndRadius
+    from curvature.post_processors.add_segment_curvature import AddSegmentCurvature
+    from curvature.post_processors.inflate_curvature_for_tagged_ways import InflateCurvatureForTaggedWays
+    from curvature.post_processors.roll_up_curvature import RollUpCurvature
+    def process(collections):
+        # Each collection is changed by the second pass after all have been
+        # through the first, as when a sort is run between them.
+        collections = list(chain_post_processors(collections, [AddSegmentLengthAndRadius(), AddSegmentCurvature()]))
+        return list(chain_post_processors(collections, [InflateCurvatureForTaggedWays(curvature=5, tag='ref', values=['US 2;VT 100']), RollUpCurvature()]))
+    routes = list(chain_post_processors(routes, [AddSegments()]))
+    data, default_result = write_and_read(deepcopy(routes))
+    expected = process(default_result)
+    data, result = write_and_read(deepcopy(routes), normalized=True, **options)
+    result = process(result)
+    assert result == expected
+    # Each copy of the shared way has two segments inflated once.
+    assert [collection['curvature'] for collection in result] == [10, 10, 10]
+
+def test_normalized_unpacks_eagerly(routes):
+    data, result = write_and_read(deepcopy(routes), normalized=True, packed_coords=True)
+    result = list(read_stream(io.BytesIO(data), lazy_coords=False))
+    for collection in result:
+        for way in collection['ways']:
+            assert type(way['coords']) == list
+
+def test_normalized_reuses_slots(collected, routes, monkeypatch):
+    monkeypatch.setattr(stream, 'MAX_RECORDS', 4)
+    collections = []
+    for i in range(10):
+        for collection in deepcopy(routes + collected):
+            for way in collection['ways']:
+                way['id'] += i % 3
+            collections.append(collection)
+    # Too many ways to normalize.
+    collections.append({'join_type': 'none', 'ways': deepcopy(collected[0]['ways'] + routes[1]['ways'])})
+    default_data, default_result = write_and_read(deepcopy(collections))
+    data, result = write_and_read(deepcopy(collections), normalized=True, string_table=True)
+    assert result == default_result